@@ -0,0 +1,168 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import socketserver
+
+import main
+
+
+#LOCAL SMTP SERVER
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough of SMTP for smtplib: EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP and QUIT, each delayed by the server latency.
+    def handle(self):
+        self.reply("220 localhost Local SMTP stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+
+            if verb == 'EHLO':
+                self.reply("250-localhost", "250-AUTH PLAIN LOGIN", "250-8BITMIME", "250 SMTPUTF8")
+            elif verb == 'HELO':
+                self.reply("250 localhost")
+            elif verb == 'AUTH':
+                self.server.count('logins')
+                self.reply("235 Authentication successful")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                self.server.count('messages')
+                self.reply("250 Message accepted")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply("250 OK")
+            else:
+                self.reply("502 Command not implemented")
+
+    def reply(self, *lines):
+        self.wfile.write("".join(line + "\r\n" for line in lines).encode('utf-8'))
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), LocalSMTPHandler)
+        self.latency = latency
+        self.counts = {'logins': 0, 'messages': 0}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+#BENCHMARKS
+def generate_roster(filename, size, seed=0):
+    rng = random.Random(seed)
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        for i in range(size):
+            writer.writerow([f"Participant {i}", f"participant{i}@example.com", f"{rng.randrange(1, 9999)} Example Street", "Leave at the door"])
+
+def timed(results, size, present_count, stage, items, function):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        value = function()
+        seconds = time.perf_counter() - start
+    results.append({'size': size, 'present_count': present_count, 'stage': stage, 'items': items, 'seconds': round(seconds, 6), 'microseconds_per_item': round(seconds * 1e6 / items, 3) if items else None})
+    print(f"{size:>9} participants, {present_count} gifts: {stage:<8} {seconds:10.3f}s", file=sys.stderr)
+    return value
+
+def benchmark_roster(results, server, directory, roster, size, present_count, workers=1, email_limit=10000, seed=0, match_processes=None):
+    # Each roster's participants only live for this call, so the next size does not start with the last one still in memory.
+    message = "Hi [gifter_name], please buy a present for [receiver_name] and send it to [receiver_address] ([delivery_instructions])."
+    user_data, valid = timed(results, size, present_count, 'import', size, lambda: main.import_user_data_from_file(roster, present_count))
+    timed(results, size, present_count, 'match', size * present_count, lambda: main.determine_gifting_pairs(user_data, present_count, processes=match_processes, seed=seed))
+    template = main.compile_message_template(message)
+    timed(results, size, present_count, 'render', size, lambda: sum(1 for _ in main.render_user_messages(template, user_data)))
+    pairs_file = os.path.join(directory, f"pairs_{size}_{present_count}.txt")
+    timed(results, size, present_count, 'save', size, lambda: main.save_pairs_to_file(user_data, filename=pairs_file))
+    if size <= email_limit:
+        # A fast email stage only counts if every email actually reached the server.
+        messages_before = server.counts['messages']
+        failed = timed(results, size, present_count, 'email', size, lambda: main.emailing_users(user_data, template, "benchmark@example.com", "password", workers=workers, host='127.0.0.1', port=server.port, use_starttls=False))
+        results[-1]['failed'] = failed
+        results[-1]['server_messages'] = server.counts['messages'] - messages_before
+        if failed or results[-1]['server_messages'] != size:
+            results[-1]['error'] = f"{failed} emails failed and the server received {results[-1]['server_messages']} out of {size}"
+            print(f"{size:>9} participants, {present_count} gifts: email stage error: {results[-1]['error']}", file=sys.stderr)
+
+def run_benchmarks(sizes, gift_counts, latency=0.0, workers=1, email_limit=10000, seed=0, match_processes=None):
+    results = []
+    server = LocalSMTPServer(latency).start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                roster = os.path.join(directory, f"roster_{size}.csv")
+                generate_roster(roster, size, seed)
+                for present_count in gift_counts:
+                    if present_count < size:
+                        benchmark_roster(results, server, directory, roster, size, present_count, workers, email_limit, seed, match_processes)
+    finally:
+        server.stop()
+    return results
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Secret Santa Emailer pipeline against a local SMTP stand-in.")
+    parser.add_argument('--sizes', default="100,10000,1000000", help="comma separated roster sizes")
+    parser.add_argument('--gifts', default="1,3", help="comma separated gift counts per participant")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the local SMTP server waits before each reply")
+    parser.add_argument('--workers', type=int, default=1, help="email connections used by the email stage")
+    parser.add_argument('--email-limit', type=int, default=10000, help="largest roster that is also emailed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--match-processes', type=int, default=None, help="match in blocks spread over this many processes")
+    parser.add_argument('--output', help="write the JSON report here instead of standard output")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    gift_counts = [int(count) for count in args.gifts.split(',')]
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'settings': {'latency': args.latency, 'workers': args.workers, 'email_limit': args.email_limit, 'seed': args.seed, 'match_processes': args.match_processes},
+        'results': run_benchmarks(sizes, gift_counts, args.latency, args.workers, args.email_limit, args.seed, args.match_processes),
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if any('error' in result for result in report['results']) else 0
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
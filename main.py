@@ -1,61 +1,1034 @@
 import os
-import smtplib
 import csv
 import random
-from dotenv import load_dotenv
+import time
+import queue
+import threading
+import collections
+import collections.abc
+import re
+import difflib
+import json
+import mmap
+import struct
+import hashlib
+import sys
+import argparse
+import contextlib
+import itertools
+from array import array
+
+MESSAGE_PLACEHOLDERS = ('gifter_name', 'receiver_name', 'receiver_address', 'delivery_instructions')
+
+#LAZY IMPORTS
+# smtplib, dotenv, NumPy, sqlite3 and the process pool are slow to import compared to the rest of the program,
+# so each is imported by the functions that need it and a validation or dry run never pays for them.
+def load_dotenv():
+    from dotenv import load_dotenv as load_environment
+    return load_environment()
+
+def load_numpy():
+    # Returns NumPy, or None when it is not installed.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
 
 #TESTING:
 def evaluate_gifting_pairs(user_data, present_count):
+    names, rows, unknown = assignment_rows_from_user_data(user_data)
+    report = validate_gifting_rows(rows, present_count, unknown)
+    print_validation_report(report, names)
+    return report['valid']
+
+def assignment_rows_from_user_data(user_data):
+    names = list(user_data.keys())
+    index = {name: i for i, name in enumerate(names)}
+    rows = []
+    unknown = []
+    for giver, name in enumerate(names):
+        row = []
+        for receiver in user_data[name]['gifting_to']:
+            if receiver in index:
+                row.append(index[receiver])
+            else:
+                unknown.append((giver, receiver))
+        rows.append(row)
+    return names, rows, unknown
+
+def validate_gifting_rows(rows, present_count, unknown=()):
+    # rows[i] lists the recipient ids of participant i; rows of the right length are checked as one flat array.
+    participant_count = len(rows)
+    if all(len(row) == present_count for row in rows):
+        flat = array('i', itertools.chain.from_iterable(rows))
+        report = validate_gifting_assignment(flat, participant_count, present_count)
+    else:
+        report = validate_ragged_rows(rows, present_count)
+    report['unknown_recipients'] = list(unknown)
+    report['valid'] = report['valid'] and not unknown
+    return report
+
+def validate_gifting_assignment(assignment, participant_count, present_count):
+    # Checks a flat assignment of participant_count * present_count recipient ids in one pass:
+    # out-degrees, in-degrees computed from the assignment itself, self-gifts, duplicates and out-of-range ids.
+    if len(assignment) != participant_count * present_count:
+        rows = [list(assignment[i * present_count:(i + 1) * present_count]) for i in range(participant_count)]
+        return validate_ragged_rows(rows, present_count)
+    if participant_count > 0 and present_count > 0 and load_numpy() is not None:
+        return validate_assignment_numpy(assignment, participant_count, present_count)
+
+    rows = (assignment[i * present_count:(i + 1) * present_count] for i in range(participant_count))
+    return validate_ragged_rows(rows, present_count, participant_count)
+
+def validate_assignment_numpy(assignment, participant_count, present_count):
+    np = load_numpy()
+    if isinstance(assignment, array):
+        matrix = np.frombuffer(assignment, dtype=np.dtype(f'i{assignment.itemsize}'))
+    else:
+        matrix = np.asarray(assignment, dtype=np.int64)
+    matrix = matrix.reshape(participant_count, present_count)
+    in_range = (matrix >= 0) & (matrix < participant_count)
+    givers = np.arange(participant_count)
+
+    out_of_range = np.argwhere(~in_range)
+    self_givers = np.nonzero((matrix == givers[:, None]).any(axis=1))[0]
+    # Out-of-range ids are reported on their own, as in validate_ragged_rows(); giving each column its own
+    # negative stand-in keeps them from being counted as duplicates too.
+    ordered = np.sort(np.where(in_range, matrix, -1 - np.arange(present_count)), axis=1)
+    repeats = np.argwhere(ordered[:, 1:] == ordered[:, :-1])
+    duplicates = sorted({(int(giver), int(ordered[giver, column])) for giver, column in repeats})
+    in_degree = np.bincount(matrix[in_range], minlength=participant_count)
+    wrong_in = np.nonzero(in_degree != present_count)[0]
+
+    return {
+        'valid': not (len(out_of_range) or len(self_givers) or duplicates or len(wrong_in)),
+        'participants': participant_count,
+        'present_count': present_count,
+        'wrong_out_degree': [],
+        'wrong_in_degree': [(int(receiver), int(in_degree[receiver])) for receiver in wrong_in],
+        'self_gifts': [int(giver) for giver in self_givers],
+        'duplicate_gifts': duplicates,
+        'out_of_range': [(int(giver), int(matrix[giver, column])) for giver, column in out_of_range],
+    }
+
+def validate_ragged_rows(rows, present_count, participant_count=None):
+    rows = rows if participant_count is not None else list(rows)
+    if participant_count is None:
+        participant_count = len(rows)
+    in_degree = [0] * participant_count
+    report = {'valid': True, 'participants': participant_count, 'present_count': present_count, 'wrong_out_degree': [], 'wrong_in_degree': [], 'self_gifts': [], 'duplicate_gifts': [], 'out_of_range': []}
+    for giver, row in enumerate(rows):
+        if len(row) != present_count:
+            report['wrong_out_degree'].append((giver, len(row)))
+        seen = set()
+        repeated = set()
+        for receiver in row:
+            if receiver < 0 or receiver >= participant_count:
+                report['out_of_range'].append((giver, receiver))
+                continue
+            in_degree[receiver] += 1
+            if receiver in seen:
+                repeated.add(receiver)
+            seen.add(receiver)
+        if giver in seen:
+            report['self_gifts'].append(giver)
+        report['duplicate_gifts'].extend((giver, receiver) for receiver in sorted(repeated))
+    report['wrong_in_degree'] = [(receiver, count) for receiver, count in enumerate(in_degree) if count != present_count]
+    report['valid'] = not any(report[key] for key in ('wrong_out_degree', 'wrong_in_degree', 'self_gifts', 'duplicate_gifts', 'out_of_range'))
+    return report
+
+def print_validation_report(report, names=None, limit=None):
+    def label(index):
+        return f"'{names[index]}'" if names is not None else f"#{index + 1}"
+
+    present_count = report['present_count']
+    problems = []
+    for giver, count in report['wrong_out_degree']:
+        problems.append(f"Participant {label(giver)} is assigned to gift {count} participants instead of {present_count}.")
+    for receiver, count in report['wrong_in_degree']:
+        problems.append(f"Participant {label(receiver)} has been gifted {count} gifts instead of {present_count}.")
+    for giver in report['self_gifts']:
+        problems.append(f"Participant {label(giver)} has been assigned to gift themselves.")
+    for giver, receiver in report['duplicate_gifts']:
+        problems.append(f"Participant {label(giver)} has been assigned to gift {label(receiver)} more than once.")
+    for giver, receiver in report['out_of_range']:
+        problems.append(f"Participant {label(giver)} has been assigned to gift a participant id {receiver} that does not exist.")
+    for giver, receiver in report.get('unknown_recipients', []):
+        problems.append(f"Participant {label(giver)} has been assigned to gift '{receiver}', who is not a participant.")
+
     print()
-    for name, data in user_data.items():
-        if len(data['gifting_to']) != present_count:
-            print(f"Incorrect gifting pairs found: Participant '{name}' is assigned to gift {len(data['gifting_to'])} participants instead of {present_count}.")
-            return False
-            
-        if data['number_of_unassigned_gifters'] != 0:
-            print(f"Incorrect gifting pairs found: Participant '{name}' has been only gifted {data['number_of_unassigned_gifters']} gifts instead of {present_count}.")
-            return False
-        prior_gifts = []
-        for i in data['gifting_to']:
-            if i in prior_gifts:
-                print("Incorrect gifting pairs found: A participant has been assigned to gift the same person more than once.")
-                return False
-            prior_gifts.append(i)
-    print("All gifting pairs have been correctly assigned.")
-    return True
+    if not problems:
+        print("All gifting pairs have been correctly assigned.")
+        return
+    for problem in problems[:limit]:
+        print(f"Incorrect gifting pairs found: {problem}")
+    if limit is not None and len(problems) > limit:
+        print(f"... and {len(problems) - limit} more problems.")
+    print(f"{len(problems)} problems were found in the gifting pairs of {report['participants']} participants.")
+
+def validate_pairs_file(filename, present_count=None):
+    if os.path.splitext(filename)[1].lower() in ('.bin', '.npz'):
+        try:
+            names, assignment, saved_present_count = load_gifting_assignment(filename)
+        except PAIRS_READ_ERRORS as e:
+            print(f"Failed to read the pairs file '{filename}': {e}")
+            return None, None
+        if present_count is None or present_count == saved_present_count:
+            return validate_gifting_assignment(assignment, len(names), saved_present_count), names
+    pairs = load_gifting_pairs(filename)
+    if pairs is None:
+        return None, None
+    user_data = {name: {'gifting_to': gifting_to} for name, gifting_to in pairs.items()}
+    if present_count is None:
+        present_count = collections.Counter(len(gifting_to) for gifting_to in pairs.values()).most_common(1)[0][0] if pairs else 0
+    names, rows, unknown = assignment_rows_from_user_data(user_data)
+    return validate_gifting_rows(rows, present_count, unknown), names
 
 
 #HELPER FUNCTIONS
-def emailing(from_address, password, to_address, message="", login_trial=False, debug=False, verbose=False):
-    with smtplib.SMTP('smtp.gmail.com', 587) as smtp:
-        if verbose:
-            smtp.set_debuglevel(True) 
-        smtp.ehlo()
-        smtp.starttls()
-        smtp.ehlo()
-        subject = "Your Secret Santa Gift List"
-        body = message
+def new_email_session(from_address, password, debug=False, verbose=False, host='smtp.gmail.com', port=587, use_starttls=True, metrics=None, dry_run=None):
+    # The session connects lazily on its first send; open_email_session() connects straight away.
+    # With a DryRunOutbox as dry_run, emails go to it instead of an SMTP server.
+    return {'from_address': from_address, 'password': password, 'host': host, 'port': port, 'use_starttls': use_starttls, 'smtp': None, 'debug': debug, 'verbose': verbose, 'reconnects': 0, 'metrics': metrics, 'last_error': None, 'dry_run': dry_run, 'failed_phase': None}
 
-        msg = f'To:{to_address}\nSubject: {subject}\n\n{body}'
+def open_email_session(from_address, password, debug=False, verbose=False, host='smtp.gmail.com', port=587, use_starttls=True, metrics=None):
+    session = new_email_session(from_address, password, debug, verbose, host, port, use_starttls, metrics)
+    if not connect_email_session(session):
+        return None
+    return session
+
+class DryRunOutbox:
+    # Stands in for smtplib.SMTP: "sent" emails are kept in memory, or written to a file when one is given.
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.file = open(filename, 'w', encoding='utf-8') if filename else None
+        self.messages = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def sendmail(self, from_address, to_address, msg):
+        with self.lock:
+            self.count += 1
+            if self.file is None:
+                self.messages.append((from_address, to_address, msg))
+            else:
+                self.file.write(f"From {from_address or 'dry-run'}\n{msg.decode('utf-8')}\n\n")
 
+    def quit(self):
+        pass
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def describe(self):
+        where = f"written to '{self.filename}'" if self.filename else "kept in memory"
+        return f"Dry run: no emails were sent. {self.count} emails were {where} instead."
+
+def open_dry_run_outbox(filename=None):
+    try:
+        return DryRunOutbox(filename)
+    except OSError:
+        print(f"Failed to open the dry run file '{filename}'. Please ensure the file is accessible.")
+        return None
+
+def timed_smtp_phase(session, phase, function, *args):
+    if session['metrics'] is None:
+        return function(*args)
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        session['metrics'].observe(phase, time.perf_counter() - start)
+
+def count_smtp_event(session, event):
+    if session['metrics'] is not None:
+        session['metrics'].increment(event)
+
+def connect_email_session(session):
+    close_email_session(session)
+    count_smtp_event(session, 'connections')
+    if session['dry_run'] is not None:
+        session['smtp'] = session['dry_run']
+        return True
+    import smtplib
+    try:
+        smtp = timed_smtp_phase(session, 'connect', smtplib.SMTP, session['host'], session['port'])
+        if session['verbose']:
+            smtp.set_debuglevel(True)
+        timed_smtp_phase(session, 'ehlo', smtp.ehlo)
+        if session['use_starttls']:
+            timed_smtp_phase(session, 'starttls', smtp.starttls)
+            timed_smtp_phase(session, 'ehlo', smtp.ehlo)
+    except Exception as e:
+        session['last_error'] = e
+        session['failed_phase'] = 'connect'
+        count_smtp_event(session, 'connection_failures')
+        print(f"Failed to connect to the email server {session['host']}:{session['port']}.")
+        if session['debug']:
+            print(f"Error: {e}")
+        return False
+
+    try:
+        timed_smtp_phase(session, 'login', smtp.login, session['from_address'], session['password'])
+    except Exception as e:
+        session['last_error'] = e
+        session['failed_phase'] = 'login'
+        count_smtp_event(session, 'login_failures')
+        print(f"Login failed. Check your email and password.")
+        if session['debug']:
+            print(f"Error: {e}")
         try:
-            smtp.login(from_address, password)
-            if login_trial:
-                return True
-        except Exception as e:
-            print(f"Login failed. Check your email and password.")
-            if debug:
-                print(f"Error: {e}")
-            return False
+            smtp.quit()
+        except Exception:
+            pass
+        return False
+    session['smtp'] = smtp
+    session['failed_phase'] = None
+    return True
+
+def close_email_session(session):
+    smtp = session['smtp']
+    session['smtp'] = None
+    if smtp is None:
+        return
+    try:
+        timed_smtp_phase(session, 'quit', smtp.quit)
+    except Exception:
+        smtp.close()
 
+def build_email(to_address, message=""):
+    subject = "Your Secret Santa Gift List"
+    return f'To:{to_address}\nSubject: {subject}\n\n{message}'
+
+def send_session_email(session, to_address, message="", max_reconnects=2):
+    msg = build_email(to_address, message).encode('utf-8')
+    if session['dry_run'] is not None:
+        # There is no server to lose, so none of the reconnect handling below applies (and smtplib is never imported).
+        if session['smtp'] is None:
+            connect_email_session(session)
         try:
-            smtp.sendmail(from_address, to_address, msg.encode('utf-8'))
+            timed_smtp_phase(session, 'sendmail', session['smtp'].sendmail, session['from_address'], to_address, msg)
+        except OSError as e:
+            session['last_error'] = e
+            print(f"Failed to write the email to {to_address} to the dry run file.")
+            return False
+        session['last_error'] = None
+        return True
+    import smtplib
+    attempt = 0
+    while True:
+        if session['smtp'] is None and not connect_email_session(session):
+            return False
+        try:
+            timed_smtp_phase(session, 'sendmail', session['smtp'].sendmail, session['from_address'], to_address, msg)
+            session['last_error'] = None
+            return True
+        except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+            session['last_error'] = e
+            session['smtp'] = None
+            count_smtp_event(session, 'disconnects')
+            if attempt >= max_reconnects:
+                print(f"Lost connection to the email server while sending to {to_address}.")
+                if session['debug']:
+                    print(f"Error: {e}")
+                return False
+            attempt += 1
+            session['reconnects'] += 1
+            count_smtp_event(session, 'reconnects')
         except Exception as e:
-            print(f"Failed to send email to {to_address} from {from_address}.")
-            if debug:
+            session['last_error'] = e
+            count_smtp_event(session, 'send_errors')
+            print(f"Failed to send email to {to_address} from {session['from_address']}.")
+            if session['debug']:
                 print(f"Error: {e}")
             return False
-        return True
+
+def is_transient_smtp_error(error):
+    # 4xx replies and dropped or refused connections are worth retrying; 5xx replies are not.
+    import smtplib
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, reply in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+def retry_delay(attempt, base_delay=1.0, max_delay=60.0):
+    return min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+def emailing(from_address, password, to_address, message="", login_trial=False, debug=False, verbose=False):
+    session = open_email_session(from_address, password, debug, verbose)
+    if session is None:
+        return False
+    try:
+        if login_trial:
+            return True
+        return send_session_email(session, to_address, message)
+    finally:
+        close_email_session(session)
+
+def compile_message_template(message):
+    # Splits the message once into literal text and placeholder slots, so each email is rendered with a single join.
+    parts = []
+    slots = []
+    misspelled = []
+    position = 0
+    for match in re.finditer(r"\[([A-Za-z_]+)\]", message):
+        placeholder = match.group(1)
+        if placeholder not in MESSAGE_PLACEHOLDERS:
+            suggestion = difflib.get_close_matches(placeholder.lower(), MESSAGE_PLACEHOLDERS, n=1, cutoff=0.75)
+            if suggestion and (placeholder, suggestion[0]) not in misspelled:
+                misspelled.append((placeholder, suggestion[0]))
+            continue
+        parts.append(message[position:match.start()])
+        slots.append((len(parts), placeholder))
+        parts.append('')
+        position = match.end()
+    parts.append(message[position:])
+    return {'parts': parts, 'slots': slots, 'misspelled': misspelled}
+
+def render_message(template, fields):
+    parts = template['parts'].copy()
+    for index, placeholder in template['slots']:
+        parts[index] = fields[placeholder]
+    return ''.join(parts)
+
+def render_user_messages(template, user_data):
+    if isinstance(template, str):
+        template = compile_message_template(template)
+    for name, data in user_data.items():
+        receivers = [user_data[gifting_to] for gifting_to in data['gifting_to']]
+        fields = {
+            'gifter_name': name,
+            'receiver_name': ", ".join(data['gifting_to']),
+            'receiver_address': ", ".join(receiver['address'] for receiver in receivers),
+            'delivery_instructions': "; ".join(receiver['delivery_instructions'] for receiver in receivers),
+        }
+        yield name, data['email'], render_message(template, fields)
+
+def create_rate_limiter(max_per_second=None):
+    if not max_per_second or max_per_second <= 0:
+        return None
+    return {'interval': 1.0 / max_per_second, 'next_slot': time.monotonic(), 'lock': threading.Lock()}
+
+def wait_for_rate_limit(limiter):
+    if limiter is None:
+        return
+    with limiter['lock']:
+        now = time.monotonic()
+        slot = max(now, limiter['next_slot'])
+        limiter['next_slot'] = slot + limiter['interval']
+    if slot > now:
+        time.sleep(slot - now)
+
+def dispatch_emails(messages, from_address, password, debug=False, verbose=False, workers=1, max_per_second=None, host='smtp.gmail.com', port=587, use_starttls=True, metrics=None, journal=None, max_retries=3, base_retry_delay=1.0, relays=None, dry_run=None, max_connect_failures=3):
+    # Without a relay pool every email goes out through the one account given; otherwise each relay gets its own
+    # connections, rate limit and queue, and emails beyond every relay's quota are deferred to the next window.
+    # A dry run never touches the relays, so it uses none of their quota.
+    # After max_connect_failures connection or login failures in a row a relay is taken out of rotation and the emails
+    # queued for it go round again through the others; once none is left they are journalled as pending instead of each
+    # waiting through its own retries.
+    if relays is None or dry_run is not None:
+        relays = new_relay_pool([new_relay(from_address, password, host, port, use_starttls, workers, max_per_second)])
+    results = {'invalid_emails': 0, 'deferred': 0, 'pending': 0, 'stranded': [], 'lock': threading.Lock()}
+
+    def record_pending(job):
+        if metrics is not None:
+            metrics.increment('emails_pending')
+        if journal is not None:
+            record_send_attempt(journal, job[0], job[1], 'pending', 0)
+        with results['lock']:
+            results['pending'] += 1
+
+    def note_connection(relay, session, email_success):
+        with relays['lock']:
+            if email_success or session['failed_phase'] is None:
+                relay['connect_failures'] = 0
+                return
+            relay['connect_failures'] += 1
+            if not relay['healthy']:
+                return
+            # A refused login will not get better by retrying, so that relay is out at once.
+            if session['failed_phase'] == 'login' and not is_transient_smtp_error(session['last_error']):
+                relay['healthy'] = False
+                print(f"The login to {relay['host']}:{relay['port']} as {relay['from_address']} was refused, so no more emails will be sent through it.")
+            elif relay['connect_failures'] >= max_connect_failures:
+                relay['healthy'] = False
+                print(f"Could not reach {relay['host']}:{relay['port']} as {relay['from_address']} after {relay['connect_failures']} tries in a row, so no more emails will be sent through it.")
+
+    def worker(relay):
+        session = new_email_session(relay['from_address'], relay['password'], debug, verbose, relay['host'], relay['port'], relay['use_starttls'], metrics, dry_run)
+        while True:
+            job = relay['jobs'].get()
+            if job is None:
+                break
+            if not relay['healthy']:
+                release_relay(relays, relay)
+                with results['lock']:
+                    results['stranded'].append(job)
+                continue
+            name, to_address, personalized_message = job
+            attempt = 0
+            while True:
+                attempt += 1
+                wait_for_rate_limit(relay['limiter'])
+                email_success = send_session_email(session, to_address, personalized_message)
+                note_connection(relay, session, email_success)
+                if email_success or attempt > max_retries or not relay['healthy'] or not is_transient_smtp_error(session['last_error']):
+                    break
+                if metrics is not None:
+                    metrics.increment('retries')
+                time.sleep(retry_delay(attempt, base_retry_delay))
+            if not email_success and not relay['healthy']:
+                release_relay(relays, relay)
+                with results['lock']:
+                    results['stranded'].append(job)
+                continue
+            if not email_success:
+                release_relay(relays, relay)
+            if metrics is not None:
+                metrics.increment('emails_sent' if email_success else 'emails_failed')
+            if journal is not None:
+                error = '' if email_success else repr(session['last_error'])
+                record_send_attempt(journal, name, to_address, 'sent' if email_success else 'failed', attempt, error)
+            with results['lock']:
+                if email_success:
+                    print(f"Email successfully sent to {name} ({to_address}) for gifting.")
+                else:
+                    print(f"Failed to send email to {name} ({to_address}) for gifting.")
+                    results['invalid_emails'] += 1
+        close_email_session(session)
+
+    def send_round(jobs):
+        threads, active = [], []
+        for relay in relays['relays']:
+            relay['jobs'] = queue.Queue(maxsize=relay['connections'] * 4)
+            relay['limiter'] = create_rate_limiter(relay['max_per_second'])
+            relay['assigned'] = 0
+            if relay['healthy']:
+                active.append(relay)
+                threads += [threading.Thread(target=worker, args=(relay,), daemon=True) for _ in range(relay['connections'])]
+        for thread in threads:
+            thread.start()
+        for job in jobs:
+            relay = reserve_relay(relays)
+            if relay is not None:
+                relay['jobs'].put(job)
+                continue
+            if not any(candidate['healthy'] for candidate in relays['relays']):
+                record_pending(job)
+                continue
+            results['deferred'] += 1
+            if metrics is not None:
+                metrics.increment('emails_deferred')
+            if journal is not None:
+                record_send_attempt(journal, job[0], job[1], 'deferred', 0)
+        for relay in active:
+            for _ in range(relay['connections']):
+                relay['jobs'].put(None)
+        for thread in threads:
+            thread.join()
+
+    for relay in relays['relays']:
+        relay['healthy'] = True
+        relay['connect_failures'] = 0
+    send_round(messages)
+    # Every round with stranded emails took a relay out of rotation, so this ends after at most one round per relay.
+    while results['stranded']:
+        stranded, results['stranded'] = results['stranded'], []
+        send_round(stranded)
+    save_relay_quota(relays)
+    if results['pending']:
+        print(f"{results['pending']} emails were not sent because the email server could not be reached. Fix the connection or login details, then run the same command again (with --resume unless sending a spool) to send them.")
+    if results['deferred']:
+        print(f"{results['deferred']} emails were deferred because every relay has used its sending quota. Run the same command again (with --resume unless sending a spool) after {time.strftime('%Y-%m-%d %H:%M', time.localtime(next_quota_reset(relays)))} to send them.")
+    return results['invalid_emails'] + results['deferred'] + results['pending']
+
+def generate_gifting_assignment(participant_count, present_count, rng=None, max_attempts=5, fallback=True):
+    # Returns a flat int array where the recipients of participant i are assignment[i * present_count:(i + 1) * present_count].
+    # Without fallback it returns None when the quick matchers give up, instead of running the flow matcher.
+    if rng is None:
+        rng = random.Random()
+    if present_count <= 0:
+        return array('i')
+    if present_count >= participant_count:
+        raise ValueError(f"Cannot assign {present_count} gifts per participant with only {participant_count} participants.")
+
+    if present_count == 1:
+        # Shuffling until there are no fixed points samples derangements uniformly and takes about e shuffles.
+        assignment = list(range(participant_count))
+        while True:
+            rng.shuffle(assignment)
+            if all(assignment[i] != i for i in range(participant_count)):
+                return array('i', assignment)
+
+    if 2 * present_count > participant_count - 1:
+        # Dense draws are the complement of a sparse one: who each participant does not gift is itself a valid draw
+        # of participant_count - 1 - present_count gifts, and drawing that uniformly draws this uniformly.
+        return complement_gifting_assignment(participant_count, generate_gifting_assignment(participant_count, participant_count - 1 - present_count, rng))
+
+    for _ in range(max_attempts):
+        assignment = layered_gifting_assignment(participant_count, present_count, rng)
+        if assignment is not None:
+            return assignment
+    if not fallback:
+        return None
+    return constrained_gifting_assignment(participant_count, present_count, [frozenset()] * participant_count, rng=rng)
+
+def complement_gifting_assignment(participant_count, complement):
+    # Each giver gifts everyone except themselves and the recipients listed for them in complement.
+    complement_count = len(complement) // participant_count if participant_count else 0
+    assignment = array('i')
+    for giver in range(participant_count):
+        skipped = set(complement[giver * complement_count:(giver + 1) * complement_count])
+        skipped.add(giver)
+        assignment.extend(receiver for receiver in range(participant_count) if receiver not in skipped)
+    return assignment
+
+def layered_gifting_assignment(participant_count, present_count, rng, max_swap_tries=100, set_threshold=8):
+    # Each round is a random permutation; clashes with self or earlier rounds are fixed by swapping recipients with another giver.
+    # A clash check must not rescan a giver's earlier rounds: above set_threshold gifts each giver keeps a set of them,
+    # below it the slice is so short that scanning it is cheaper than a million small sets.
+    assignment = array('i', [0]) * (participant_count * present_count)
+    earlier = [set() for _ in range(participant_count)] if present_count > set_threshold else None
+
+    def clashes(giver, receiver, layer):
+        if receiver == giver:
+            return True
+        if earlier is not None:
+            return receiver in earlier[giver]
+        start = giver * present_count
+        return receiver in assignment[start:start + layer]
+
+    for layer in range(present_count):
+        perm = list(range(participant_count))
+        rng.shuffle(perm)
+        for giver in range(participant_count):
+            # Same test as clashes(), written out because it runs once per giver per round.
+            receiver = perm[giver]
+            if receiver != giver and (receiver not in earlier[giver] if earlier is not None else receiver not in assignment[giver * present_count:giver * present_count + layer]):
+                continue
+            for _ in range(max_swap_tries):
+                other = rng.randrange(participant_count)
+                if not clashes(giver, perm[other], layer) and not clashes(other, perm[giver], layer):
+                    perm[giver], perm[other] = perm[other], perm[giver]
+                    break
+            else:
+                return None
+        for giver in range(participant_count):
+            assignment[giver * present_count + layer] = perm[giver]
+            if earlier is not None:
+                earlier[giver].add(perm[giver])
+    return assignment
+
+SHARD_SIZE = 250000
+
+def match_shard(job):
+    # Runs in a worker process; the block's generator is seeded from (seed, block) alone so the worker count never changes the result.
+    members, present_count, seed, block = job
+    shard = generate_gifting_assignment(len(members), present_count, random.Random(f"{seed}:{block}"))
+    return array('i', [members[receiver] for receiver in shard])
+
+def sharded_gifting_assignment(participant_count, present_count, seed, processes=None, shard_size=SHARD_SIZE, max_stitch_tries=10000):
+    # Deals participants at random into fixed blocks of shard_size to 2 * shard_size, so a roster sorted by office or team
+    # does not decide who can draw whom, matches each block in its own process, then joins neighbouring blocks into a ring
+    # by swapping the recipients of one giver on each side, once per round.
+    if seed is None:
+        seed = random.SystemRandom().randrange(1 << 64)
+    order = list(range(participant_count))
+    random.Random(f"{seed}:order").shuffle(order)
+    block_count = max(1, participant_count // max(shard_size, present_count + 1))
+    bounds = [block * participant_count // block_count for block in range(block_count + 1)]
+    jobs = [(order[bounds[block]:bounds[block + 1]], present_count, seed, block) for block in range(block_count)]
+    if processes == 1 or block_count == 1:
+        shards = map(match_shard, jobs)
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        shards = executor.map(match_shard, jobs)
+    assignment = array('i', [0]) * (participant_count * present_count)
+    try:
+        for (members, _, _, _), shard in zip(jobs, shards):
+            for position, giver in enumerate(members):
+                start = giver * present_count
+                assignment[start:start + present_count] = shard[position * present_count:(position + 1) * present_count]
+    finally:
+        if processes != 1 and block_count > 1:
+            executor.shutdown()
+    if block_count == 1:
+        return assignment
+
+    rng = random.Random(f"{seed}:stitch")
+    for layer in range(present_count):
+        for block in range(block_count):
+            next_block = (block + 1) % block_count
+            for _ in range(max_stitch_tries):
+                giver = order[rng.randrange(bounds[block], bounds[block + 1])]
+                other = order[rng.randrange(bounds[next_block], bounds[next_block + 1])]
+                giver_start = giver * present_count
+                other_start = other * present_count
+                receiver = assignment[giver_start + layer]
+                other_receiver = assignment[other_start + layer]
+                if other_receiver != giver and receiver != other and other_receiver not in assignment[giver_start:giver_start + present_count] and receiver not in assignment[other_start:other_start + present_count]:
+                    assignment[giver_start + layer] = other_receiver
+                    assignment[other_start + layer] = receiver
+                    break
+            else:
+                raise ValueError(f"Could not link block {block} to block {next_block} after {max_stitch_tries} tries.")
+    return assignment
+
+def import_exclusions_from_file(filename, user_data):
+    exclusions = set()
+    valid = True
+    try:
+        with open(filename, 'r', newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            counter = 0
+            for row in reader:
+                counter += 1
+                group = [name.strip() for name in row if name.strip() != '']
+                if len(group) == 0:
+                    continue
+                if len(group) < 2:
+                    print(f"Invalid row in exclusion file, Row number {counter}: {row}. Each row must contain at least two names.")
+                    valid = False
+                    continue
+                unknown = [name for name in group if name not in user_data]
+                if unknown:
+                    print(f"Unknown participant in exclusion file, Row number {counter}: {', '.join(unknown)}. Names must match the participant list exactly.")
+                    valid = False
+                    continue
+                for giver in group:
+                    for receiver in group:
+                        if giver != receiver:
+                            exclusions.add((giver, receiver))
+    except:
+        print(f"Failed to read the file '{filename}'. Please ensure the file exists and is accessible as a csv.")
+        valid = False
+    return exclusions, valid
+
+def build_exclusion_index(names, exclusions):
+    # excluded[i] holds the indices participant i may not gift to.
+    index = {name: i for i, name in enumerate(names)}
+    excluded = [set() for _ in names]
+    for giver, receiver in exclusions or ():
+        if giver in index and receiver in index:
+            excluded[index[giver]].add(index[receiver])
+    return excluded
+
+def constrained_gifting_assignment(participant_count, present_count, excluded, households=None, rng=None, names=None):
+    # Treats the draw as a flow problem: every giver sends present_count gifts and every receiver takes present_count.
+    # A random unconstrained draw minus its forbidden pairs is a valid partial flow; augmenting paths then complete it,
+    # and when no augmenting path is left the flow is maximum, so a missing gift proves no valid draw exists.
+    if rng is None:
+        rng = random.Random()
+    k = present_count
+    n = participant_count
+    if k <= 0:
+        return array('i')
+    if k >= n:
+        print(f"No valid gifting pairs exist: {n} participants cannot each give {k} gifts.")
+        return None
+
+    household_ids = [-1] * n
+    household_members = {}
+    if households is not None:
+        for i, household in enumerate(households):
+            if household != 'N/A':
+                household_members.setdefault(household, []).append(i)
+    household_members_list = list(household_members.values())
+    for household_id, members in enumerate(household_members_list):
+        for i in members:
+            household_ids[i] = household_id
+
+    def blocked(giver, receiver):
+        return giver == receiver or receiver in excluded[giver] or (household_ids[giver] >= 0 and household_ids[giver] == household_ids[receiver])
+
+    def label(i):
+        return names[i] if names is not None else f"#{i + 1}"
+
+    # A household's gifts all go to people outside it, who take k gifts each, so no household can be more than half the group.
+    for members in household_members_list:
+        if len(members) > n - len(members):
+            print(f"No valid gifting pairs exist: the household of {label(members[0])} has {len(members)} of the {n} participants, but its {len(members) * k} gifts can only go to the {n - len(members)} participants outside it.")
+            return None
+
+    # Participants who may not gift, or be gifted by, enough people are reported before any matching is attempted.
+    # Only the exclusion lists are walked here, never a household's members, so one huge household stays linear.
+    excluded_by = [0] * n
+    for giver in range(n):
+        options = n - 1
+        if household_ids[giver] >= 0:
+            options -= len(household_members_list[household_ids[giver]]) - 1
+        for receiver in excluded[giver]:
+            if receiver != giver and (household_ids[giver] < 0 or household_ids[giver] != household_ids[receiver]):
+                excluded_by[receiver] += 1
+                options -= 1
+        if options < k:
+            print(f"No valid gifting pairs exist: participant {label(giver)} is only allowed to gift {options} participants but must give {k} gifts.")
+            return None
+    for receiver in range(n):
+        options = n - 1 - excluded_by[receiver]
+        if household_ids[receiver] >= 0:
+            options -= len(household_members_list[household_ids[receiver]]) - 1
+        if options < k:
+            print(f"No valid gifting pairs exist: participant {label(receiver)} can only be gifted by {options} participants but must receive {k} gifts.")
+            return None
+
+    targets = [set() for _ in range(n)]
+    givers_of = [set() for _ in range(n)]
+    # The random start is only a head start, so if the quick matchers give up the augmenting paths do all the work.
+    start = generate_gifting_assignment(n, k, rng, fallback=False)
+    if start is None:
+        start = array('i')
+    for giver in range(n):
+        for receiver in start[giver * k:(giver + 1) * k]:
+            if not blocked(giver, receiver):
+                targets[giver].add(receiver)
+                givers_of[receiver].add(giver)
+    del start
+
+    # Cheap greedy pass: give each short giver random receivers that still need gifts. When the giver may not gift
+    # that receiver, as with the dropped gifts inside a big household, a random other giver takes the receiver and
+    # hands one of its own recipients over instead, which leaves far fewer gaps for the augmenting paths.
+    open_receivers = [r for r in range(n) if len(givers_of[r]) < k]
+    open_position = {r: i for i, r in enumerate(open_receivers)}
+    for giver in range(n):
+        tries = 0
+        while len(targets[giver]) < k and open_receivers and tries < 50:
+            tries += 1
+            receiver = open_receivers[rng.randrange(len(open_receivers))]
+            if receiver in targets[giver] or blocked(giver, receiver):
+                other = rng.randrange(n)
+                if not targets[other] or receiver in targets[other] or blocked(other, receiver):
+                    continue
+                moved = rng.choice(list(targets[other]))
+                if moved in targets[giver] or blocked(giver, moved):
+                    continue
+                targets[other].discard(moved)
+                givers_of[moved].discard(other)
+                targets[other].add(receiver)
+                givers_of[receiver].add(other)
+                targets[giver].add(moved)
+                givers_of[moved].add(giver)
+            else:
+                targets[giver].add(receiver)
+                givers_of[receiver].add(giver)
+            if len(givers_of[receiver]) == k:
+                last = open_receivers.pop()
+                if last != receiver:
+                    open_receivers[open_position[receiver]] = last
+                    open_position[last] = open_position[receiver]
+                del open_position[receiver]
+
+    short_givers = [g for g in range(n) if len(targets[g]) < k]
+    while short_givers:
+        if not augment_gifting_flow(n, k, targets, givers_of, short_givers, blocked, household_ids):
+            missing = sum(k - len(targets[g]) for g in short_givers)
+            print(f"No valid gifting pairs exist under the exclusion rules: at most {n * k - missing} of the {n * k} gifts can be assigned.")
+            return None
+        short_givers = [g for g in short_givers if len(targets[g]) < k]
+
+    assignment = array('i')
+    for giver in range(n):
+        assignment.extend(targets[giver])
+    return assignment
+
+def augment_gifting_flow(participant_count, present_count, targets, givers_of, short_givers, blocked, household_ids=None):
+    # Breadth-first search for one augmenting path from any short giver to any short receiver.
+    # Forward steps are allowed new pairs; backward steps reroute a giver away from a receiver it already gifts.
+    # Unvisited receivers are kept in sets by household and a giver never scans its own household's set,
+    # so each receiver is scanned once plus once per excluded pair, making a search O(N + excluded pairs) however big a household is.
+    if household_ids is None:
+        household_ids = [-1] * participant_count
+    parent_of_receiver = {}
+    parent_of_giver = {giver: -1 for giver in short_givers}
+    pending = collections.deque(short_givers)
+    unvisited = {}
+    for receiver in range(participant_count):
+        unvisited.setdefault(household_ids[receiver], set()).add(receiver)
+    end = -1
+    while pending and end < 0:
+        giver = pending.popleft()
+        own = household_ids[giver]
+        reached = [r for household, members in unvisited.items() if household < 0 or household != own for r in members if r not in targets[giver] and not blocked(giver, r)]
+        for receiver in reached:
+            members = unvisited[household_ids[receiver]]
+            members.discard(receiver)
+            if not members:
+                del unvisited[household_ids[receiver]]
+            parent_of_receiver[receiver] = giver
+            if len(givers_of[receiver]) < present_count:
+                end = receiver
+                break
+            for other in givers_of[receiver]:
+                if other not in parent_of_giver:
+                    parent_of_giver[other] = receiver
+                    pending.append(other)
+    if end < 0:
+        return False
+
+    receiver = end
+    while True:
+        giver = parent_of_receiver[receiver]
+        targets[giver].add(receiver)
+        givers_of[receiver].add(giver)
+        previous = parent_of_giver[giver]
+        if previous < 0:
+            return True
+        targets[giver].discard(previous)
+        givers_of[previous].discard(giver)
+        receiver = previous
+
+def apply_gifting_assignment(user_data, names, assignment, present_count):
+    for index, name in enumerate(names):
+        start = index * present_count
+        user_data[name]['gifting_to'] = [names[receiver] for receiver in assignment[start:start + present_count]]
+        user_data[name]['number_of_unassigned_gifters'] = 0
+    return user_data
+
+def build_giver_index(user_data):
+    # Maps each participant to the people gifting to them, so a join or leave only has to look at O(k) edges.
+    givers = {name: [] for name in user_data}
+    for name, data in user_data.items():
+        for receiver in data['gifting_to']:
+            givers[receiver].append(name)
+    return givers
+
+def gifting_allowed(user_data, exclusions, giver, receiver):
+    if giver == receiver or receiver in user_data[giver]['gifting_to'] or (giver, receiver) in exclusions:
+        return False
+    household = user_data[giver].get('household', 'N/A')
+    return household == 'N/A' or household != user_data[receiver].get('household', 'N/A')
+
+def move_gift(user_data, givers, giver, old_receiver, new_receiver):
+    gifting_to = user_data[giver]['gifting_to']
+    gifting_to[gifting_to.index(old_receiver)] = new_receiver
+    if old_receiver in givers:
+        givers[old_receiver].remove(giver)
+    givers[new_receiver].append(giver)
+
+def add_participant_to_draw(user_data, givers, name, present_count, exclusions=(), rng=None, candidates=None, max_attempts=50):
+    # Absorbs a new participant already in user_data by replacing k edges u -> v with u -> name and name -> v.
+    # Every other participant keeps k gifts out and k in; returns the names whose gifts changed, or None.
+    if rng is None:
+        rng = random
+    if candidates is None:
+        candidates = list(givers)
+    givers.setdefault(name, [])
+    user_data[name]['gifting_to'] = []
+    user_data[name]['number_of_unassigned_gifters'] = 0
+    changed = {name}
+    attempts = 0
+    while len(user_data[name]['gifting_to']) < present_count:
+        attempts += 1
+        if attempts > max_attempts * present_count:
+            return None
+        giver = rng.choice(candidates)
+        if giver not in user_data or not user_data[giver]['gifting_to'] or not gifting_allowed(user_data, exclusions, giver, name):
+            continue
+        receiver = rng.choice(user_data[giver]['gifting_to'])
+        if not gifting_allowed(user_data, exclusions, name, receiver):
+            continue
+        move_gift(user_data, givers, giver, receiver, name)
+        user_data[name]['gifting_to'].append(receiver)
+        givers[receiver].append(name)
+        changed.add(giver)
+    candidates.append(name)
+    return changed
+
+def remove_participant_from_draw(user_data, givers, name, exclusions=(), rng=None, candidates=None, max_attempts=50):
+    # Removes a participant and hands each of their givers one of their receivers, using a k x k matching
+    # and, when no matching exists, a 2-switch with a random edge a -> b (a: b -> receiver, giver: name -> b).
+    # Returns the names whose gifts changed, or None if no repair was found and the draw must be redone.
+    if rng is None:
+        rng = random
+    if candidates is None:
+        candidates = list(givers)
+    orphaned = list(givers.pop(name))
+    receivers = list(user_data[name]['gifting_to'])
+    for receiver in receivers:
+        givers[receiver].remove(name)
+    del user_data[name]
+    rng.shuffle(orphaned)
+    rng.shuffle(receivers)
+
+    matched = {}
+    def augment(giver, seen):
+        for receiver in receivers:
+            if receiver not in seen and gifting_allowed(user_data, exclusions, giver, receiver):
+                seen.add(receiver)
+                if receiver not in matched or augment(matched[receiver], seen):
+                    matched[receiver] = giver
+                    return True
+        return False
+    for giver in orphaned:
+        augment(giver, set())
+    for receiver, giver in matched.items():
+        move_gift(user_data, givers, giver, name, receiver)
+    changed = set(orphaned)
+
+    unmatched = [giver for giver in orphaned if name in user_data[giver]['gifting_to']]
+    leftovers = [receiver for receiver in receivers if receiver not in matched]
+    for giver, receiver in zip(unmatched, leftovers):
+        for _ in range(max_attempts * len(orphaned)):
+            other = rng.choice(candidates)
+            if other == giver or other not in user_data or not user_data[other]['gifting_to'] or not gifting_allowed(user_data, exclusions, other, receiver):
+                continue
+            swapped = rng.choice(user_data[other]['gifting_to'])
+            if gifting_allowed(user_data, exclusions, giver, swapped):
+                move_gift(user_data, givers, other, swapped, receiver)
+                move_gift(user_data, givers, giver, name, swapped)
+                changed.add(other)
+                break
+        else:
+            return None
+    return changed
+
+def amend_gifting_pairs(user_data, pairs, exclusions=None, rng=None):
+    # Carries a saved draw over to an updated participant list, repairing it locally for everyone who left or joined.
+    # Returns the names whose gifts changed (they are the only ones who need a new email), or None if it cannot be done.
+    if exclusions is None:
+        exclusions = set()
+    present_count = len(next(iter(pairs.values()), []))
+    leaving = [name for name in pairs if name not in user_data]
+    joining = [name for name in user_data if name not in pairs]
+    if any(receiver not in pairs for gifting_to in pairs.values() for receiver in gifting_to):
+        print("The saved gifting pairs include recipients who are not participants in that draw.")
+        return None
+    if present_count == 0 or present_count >= len(user_data):
+        return None
+
+    for name in leaving:
+        user_data[name] = {'household': 'N/A'}
+    for name, gifting_to in pairs.items():
+        user_data[name]['gifting_to'] = list(gifting_to)
+        user_data[name]['number_of_unassigned_gifters'] = 0
+    for name in joining:
+        user_data[name]['gifting_to'] = []
+    givers = build_giver_index({name: user_data[name] for name in pairs})
+    candidates = list(pairs)
+
+    changed = set()
+    for name in leaving:
+        result = remove_participant_from_draw(user_data, givers, name, exclusions, rng, candidates)
+        if result is None:
+            break
+        changed |= result
+    else:
+        for name in joining:
+            result = add_participant_to_draw(user_data, givers, name, present_count, exclusions, rng, candidates)
+            if result is None:
+                break
+            changed |= result
+        else:
+            return {name for name in changed if name in user_data}
+    for name in leaving:
+        user_data.pop(name, None)
+    return None
 
 def display_user_data(user_data, present_count):
     internal_counter = 0
@@ -95,47 +1068,58 @@ def delete_user_data_entry(user_data, removal_list, internal_counter):
         del user_data[removal_list[delete_name - 1]]
     return user_data
 
-def import_user_data_from_file(filename, present_count):
+def read_user_rows(filename, collect_errors=False, report=None):
+    # Streams validated rows from the csv file; names and emails seen so far are kept in sets so each duplicate check is O(1).
+    if report is None:
+        report = {}
+    report['errors'] = 0
+    name_index = set()
+    email_index = set()
+    with open(filename, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        counter = 0
+        for row in reader:
+            counter += 1
+            if (len(row) < 2):
+                print(f"Invalid row in CSV file, Row number {counter}: {row}. Each row must contain at least a name and an email.")
+            elif '@' not in row[1]:
+                print(f"Invalid email address in CSV file, Row number {counter}: '{row[1]}'. Please ensure the email address is valid and is located in the second column.")
+            elif row[0] in name_index:
+                print(f"Duplicate name found in CSV file, Row number {counter}: {row[0]}. Each participant must have a unique name or nickname for clarity.")
+            elif row[1] in email_index:
+                print(f"Duplicate email address found in CSV file, Row number {counter}: '{row[1]}'. Each participant must have a unique email address.")
+            else:
+                name_index.add(row[0])
+                email_index.add(row[1])
+                address = row[2] if len(row) > 2 else 'N/A'
+                delivery_instructions = row[3] if len(row) > 3 else 'N/A'
+                household = row[4] if len(row) > 4 and row[4] != '' else 'N/A'
+                yield row[0], row[1], address, delivery_instructions, household
+                continue
+
+            report['errors'] += 1
+            if not collect_errors:
+                return
+
+def import_user_data_from_file(filename, present_count, collect_errors=False):
     user_data = {}
-    valid = True
+    report = {}
     try:
-        with open(filename, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            counter = 0
-            for row in reader:
-                counter += 1
-                if (len(row) < 2):
-                    print(f"Invalid row in CSV file, Row number {counter}: {row}. Each row must contain at least a name and an email.")
-                    valid = False
-                    break
-                elif '@' not in row[1]:
-                    print(f"Invalid email address in CSV file, Row number {counter}: '{row[1]}'. Please ensure the email address is valid and is located in the second column.")
-                    valid = False
-                    break
-                elif row[0] in user_data.keys():
-                    print(f"Duplicate name found in CSV file, Row number {counter}: {row[0]}. Each participant must have a unique name or nickname for clarity.")
-                    valid = False
-                    break
-                elif row[1] in [data['email'] for data in user_data.values()]:
-                    print(f"Duplicate email address found in CSV file, Row number {counter}: '{row[1]}'. Each participant must have a unique email address.")
-                    valid = False
-                    break
-                
-                    
-                user_data[row[0]] = {'email': row[1], 'address': 'N/A', 'delivery_instructions': 'N/A', 'gifting_to': [], 'number_of_unassigned_gifters': present_count}
-            
-                if len(row) > 2:
-                    user_data[row[0]]['address'] = row[2]
-                    if len(row) > 3:
-                        user_data[row[0]]['delivery_instructions'] = row[3]
+        for name, email, address, delivery_instructions, household in read_user_rows(filename, collect_errors, report):
+            user_data[name] = {'email': email, 'address': address, 'delivery_instructions': delivery_instructions, 'household': household, 'gifting_to': [], 'number_of_unassigned_gifters': present_count}
     except:
         print(f"Failed to read the file '{filename}'. Please ensure the file exists and is accessible as a csv.")
-        valid = False
+        return user_data, False
 
-    return user_data, valid
+    if report['errors'] > 0:
+        if collect_errors:
+            print(f"Found {report['errors']} invalid rows in '{filename}'. Please fix them and import the file again.")
+        return user_data, False
+    return user_data, True
     
 def import_user_data_from_terminal(present_count, prior_count=1, prior_user_data={}):
     user_data = prior_user_data.copy()
+    email_index = {data['email'] for data in user_data.values()}
     result = 1
     counter = prior_count
 
@@ -159,7 +1143,7 @@ def import_user_data_from_terminal(present_count, prior_count=1, prior_user_data
                 print(f"Invalid email address: '{email}'. Please ensure the email address is valid.")
                 inside_valid = False
                 continue
-            elif email in [data['email'] for data in user_data.values()]:
+            elif email in email_index:
                 print(f"Duplicate email address found: '{email}'. Each participant must have a unique email address.")
                 inside_valid = False
                 continue
@@ -174,7 +1158,13 @@ def import_user_data_from_terminal(present_count, prior_count=1, prior_user_data
         if delivery_instructions == '':
             delivery_instructions = 'N/A'
 
-        user_data[name] = {'email': email, 'address': address, 'delivery_instructions': delivery_instructions, 'gifting_to': [], 'number_of_unassigned_gifters': present_count}
+        print()
+        household = input(f"Please enter the household of participant #{counter} ({name}) so they are never matched with someone from the same household, or simply press enter to skip: ")
+        if household == '':
+            household = 'N/A'
+
+        user_data[name] = {'email': email, 'address': address, 'delivery_instructions': delivery_instructions, 'household': household, 'gifting_to': [], 'number_of_unassigned_gifters': present_count}
+        email_index.add(email)
         print(f"Added participant: {name}.")
 
         inside_valid = False
@@ -204,11 +1194,788 @@ def import_user_data_from_terminal(present_count, prior_count=1, prior_user_data
 
                 if result == 3:
                     user_data = delete_user_data_entry(user_data, removal_list, internal_counter)
+                    email_index = {data['email'] for data in user_data.values()}
         counter += 1
 
     return user_data
 
 
+#PAIRS FILES
+PAIRS_MAGIC = b"SECRETSANTA-PAIRS-1\n"
+PAIRS_FORMATS = ('.txt', '.csv', '.jsonl', '.bin', '.npz')
+# Everything reading a damaged or truncated pairs file can raise; array.fromfile() raises EOFError on a short file.
+PAIRS_READ_ERRORS = (OSError, ValueError, KeyError, IndexError, struct.error, EOFError)
+
+def describe_gifting_to(gifting_to):
+    if len(gifting_to) <= 1:
+        return "".join(gifting_to)
+    if len(gifting_to) == 2:
+        return f"{gifting_to[0]} and {gifting_to[1]}"
+    return ", ".join(gifting_to[:-1]) + ", and " + gifting_to[-1]
+
+def rows_from_assignment(names, assignment, present_count):
+    # Splits a flat recipient id array into one list of recipient names per participant.
+    receivers = map(names.__getitem__, assignment)
+    return map(list, zip(*[receivers] * present_count)) if present_count else ([] for _ in names)
+
+def iter_gifting_pairs(user_data):
+    # Yields (name, recipient names), reading a ParticipantStore's arrays directly instead of building a dict per participant.
+    if isinstance(user_data, UserDataView) and user_data.store.is_assigned():
+        store = user_data.store
+        yield from zip(store.names, rows_from_assignment(store.names, store.assignment, store.present_count))
+    else:
+        for name, data in user_data.items():
+            yield name, data['gifting_to']
+
+def write_pairs_text(filename, user_data):
+    with open(filename, 'w', buffering=1 << 20) as file:
+        file.write("Gifting Matches:\n")
+        file.writelines(f"Participant: {name}, Gifting To: {describe_gifting_to(gifting_to)}\n" for name, gifting_to in iter_gifting_pairs(user_data))
+
+def write_pairs_csv(filename, user_data):
+    # One row per participant: their name followed by everyone they gift to.
+    with open(filename, 'w', newline='', buffering=1 << 20) as file:
+        writer = csv.writer(file)
+        writer.writerows([name, *gifting_to] for name, gifting_to in iter_gifting_pairs(user_data))
+
+def write_pairs_jsonl(filename, user_data):
+    with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as file:
+        file.writelines(json.dumps({'name': name, 'gifting_to': list(gifting_to)}, ensure_ascii=False) + "\n" for name, gifting_to in iter_gifting_pairs(user_data))
+
+def assignment_arrays_from_user_data(user_data):
+    # Returns (names, flat recipient id array, gifts per participant), reusing a ParticipantStore's arrays when possible.
+    if isinstance(user_data, UserDataView) and user_data.store.is_assigned():
+        store = user_data.store
+        return store.names, store.assignment, store.present_count
+    names, rows, unknown = assignment_rows_from_user_data(user_data)
+    present_count = len(rows[0]) if rows else 0
+    if unknown or any(len(row) != present_count for row in rows):
+        return None
+    return names, array('i', itertools.chain.from_iterable(rows)), present_count
+
+def write_pairs_binary(filename, user_data):
+    # Magic line, participant and gift counts, length-prefixed UTF-8 names, then the little-endian int32 recipient ids.
+    arrays = assignment_arrays_from_user_data(user_data)
+    if arrays is None:
+        raise ValueError("binary pairs files need every participant to give the same number of gifts")
+    names, assignment, present_count = arrays
+    with open(filename, 'wb', buffering=1 << 20) as file:
+        file.write(PAIRS_MAGIC)
+        file.write(struct.pack('<II', len(names), present_count))
+        for name in names:
+            encoded = name.encode('utf-8')
+            file.write(struct.pack('<I', len(encoded)))
+            file.write(encoded)
+        ids = array('i', assignment)
+        if sys.byteorder != 'little':
+            ids.byteswap()
+        ids.tofile(file)
+
+def write_pairs_npz(filename, user_data):
+    np = load_numpy()
+    if np is None:
+        raise ValueError("saving .npz pairs files needs NumPy to be installed")
+    arrays = assignment_arrays_from_user_data(user_data)
+    if arrays is None:
+        raise ValueError(".npz pairs files need every participant to give the same number of gifts")
+    names, assignment, present_count = arrays
+    matrix = np.frombuffer(array('i', assignment), dtype=np.dtype(f'i{array("i").itemsize}')).reshape(len(names), present_count)
+    np.savez_compressed(filename, names=np.array(names, dtype=str), assignment=matrix)
+
+def write_pairs_file(filename, user_data):
+    extension = os.path.splitext(filename)[1].lower()
+    writers = {'.txt': write_pairs_text, '.csv': write_pairs_csv, '.jsonl': write_pairs_jsonl, '.bin': write_pairs_binary, '.npz': write_pairs_npz}
+    writers[extension](filename, user_data)
+
+def load_gifting_assignment(filename):
+    # Returns (names, flat recipient id array, gifts per participant) from a .bin or .npz pairs file.
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npz':
+        np = load_numpy()
+        if np is None:
+            raise ValueError("reading .npz pairs files needs NumPy to be installed")
+        with np.load(filename) as data:
+            matrix = data['assignment']
+            return [str(name) for name in data['names']], array('i', matrix.astype(np.int32).ravel().tobytes()), int(matrix.shape[1]) if matrix.ndim == 2 else 0
+    with open(filename, 'rb') as file:
+        if file.read(len(PAIRS_MAGIC)) != PAIRS_MAGIC:
+            raise ValueError("not a binary pairs file written by this program")
+        participant_count, present_count = struct.unpack('<II', file.read(8))
+        names = []
+        for _ in range(participant_count):
+            length, = struct.unpack('<I', file.read(4))
+            names.append(file.read(length).decode('utf-8'))
+        assignment = array('i')
+        assignment.fromfile(file, participant_count * present_count)
+        if sys.byteorder != 'little':
+            assignment.byteswap()
+    return names, assignment, present_count
+
+def load_gifting_pairs(filename):
+    # Returns {name: [names they gift to]} from any format save_pairs_to_file() writes, or None if it cannot be read.
+    extension = os.path.splitext(filename)[1].lower()
+    try:
+        if extension == '.txt':
+            return load_pairs_from_text_file(filename)
+        if extension == '.csv':
+            with open(filename, 'r', newline='') as file:
+                return {row[0]: row[1:] for row in csv.reader(file) if row}
+        if extension == '.jsonl':
+            pairs = {}
+            with open(filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        pairs[record['name']] = record['gifting_to']
+            return pairs
+        if extension in ('.bin', '.npz'):
+            names, assignment, present_count = load_gifting_assignment(filename)
+            return dict(zip(names, rows_from_assignment(names, assignment, present_count)))
+    except PAIRS_READ_ERRORS as e:
+        print(f"Failed to read the pairs file '{filename}': {e}")
+        return None
+    print(f"Unsupported pairs file '{filename}'. Please use a file ending in {', '.join(PAIRS_FORMATS)}.")
+    return None
+
+def load_pairs_from_text_file(filename):
+    # Reads back the "Participant: NAME, Gifting To: A, B, and C" lines of the text format.
+    # Names that themselves contain ", " or " and " cannot be told apart from the separators in this format.
+    pairs = {}
+    try:
+        with open(filename, 'r') as file:
+            for line in file:
+                line = line.rstrip("\n")
+                if not line.startswith("Participant: ") or ", Gifting To: " not in line:
+                    continue
+                name, gifting_to = line[len("Participant: "):].split(", Gifting To: ", 1)
+                if gifting_to == '':
+                    receivers = []
+                elif ", and " in gifting_to:
+                    head, last = gifting_to.rsplit(", and ", 1)
+                    receivers = head.split(", ") + [last]
+                elif " and " in gifting_to:
+                    receivers = gifting_to.split(" and ", 1)
+                else:
+                    receivers = [gifting_to]
+                pairs[name] = receivers
+    except OSError:
+        print(f"Failed to read the file '{filename}'. Please ensure the file exists and is accessible.")
+        return None
+    return pairs
+
+def apply_saved_pairs(user_data, pairs, source, present_count=None):
+    missing = [name for name in pairs if name not in user_data]
+    unknown = [name for name in user_data if name not in pairs]
+    if missing:
+        print(f"{source} includes participants missing from the participant list: {', '.join(missing[:10])}.")
+    if unknown:
+        print(f"The participant list includes people who were not part of {source.lower()}: {', '.join(unknown[:10])}.")
+    if missing or unknown:
+        return False
+    for name, gifting_to in pairs.items():
+        user_data[name]['gifting_to'] = list(gifting_to)
+        user_data[name]['number_of_unassigned_gifters'] = 0
+    # A saved draw is sent as it is, so it must pass the same checks as a new one.
+    if present_count is None:
+        present_count = len(next(iter(pairs.values()), []))
+    names, rows, unknown_recipients = assignment_rows_from_user_data(user_data)
+    report = validate_gifting_rows(rows, present_count, unknown_recipients)
+    if not report['valid']:
+        print_validation_report(report, names, limit=10)
+        print(f"{source} is not a valid draw, so no emails will be sent from it.")
+        return False
+    return True
+
+
+#OUTBOX SPOOL
+SPOOL_MAGIC = b"SECRETSANTA-SPOOL-1\n"
+
+def write_outbox_spool(filename, messages, digest='', present_count=0):
+    # The spool is the magic line followed by length-prefixed JSON records: first a header, then one record per email.
+    count = 0
+    try:
+        with open(filename, 'wb', buffering=1 << 20) as spool:
+            spool.write(SPOOL_MAGIC)
+            write_spool_record(spool, {'type': 'header', 'digest': digest, 'present_count': present_count, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            for name, email, message in messages:
+                write_spool_record(spool, {'name': name, 'email': email, 'message': message})
+                count += 1
+            spool.flush()
+            os.fsync(spool.fileno())
+    except OSError:
+        print(f"Failed to write the outbox spool '{filename}'. Please ensure the file is accessible.")
+        return -1
+    return count
+
+def write_spool_record(spool, record):
+    payload = json.dumps(record, ensure_ascii=False).encode('utf-8')
+    spool.write(struct.pack('>I', len(payload)))
+    spool.write(payload)
+
+def open_outbox_spool(filename):
+    # Memory-maps the spool so records are decoded one at a time instead of loading every message.
+    try:
+        with open(filename, 'rb') as spool:
+            if os.fstat(spool.fileno()).st_size < len(SPOOL_MAGIC):
+                raise ValueError
+            mapped = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        print(f"Failed to read the outbox spool '{filename}'. Please ensure the file exists and is a spool written by this program.")
+        return None
+    if mapped[:len(SPOOL_MAGIC)] != SPOOL_MAGIC:
+        mapped.close()
+        print(f"The file '{filename}' is not an outbox spool written by this program.")
+        return None
+    # Every record is checked before the spool is used, so a truncated or damaged file is refused before any email goes out.
+    try:
+        header, offset = read_spool_record(mapped, len(SPOOL_MAGIC))
+        if not isinstance(header, dict) or header.get('type') != 'header':
+            raise ValueError("spool has no header")
+        spool = {'mapped': mapped, 'header': header, 'start': offset}
+        spool['count'] = check_outbox_spool(spool)
+    except (struct.error, ValueError):
+        mapped.close()
+        print(f"The outbox spool '{filename}' is corrupt or was cut short, so no emails were sent from it. Please render it again with --render-only.")
+        return None
+    return spool
+
+def read_spool_record(mapped, offset):
+    length, = struct.unpack_from('>I', mapped, offset)
+    start = offset + 4
+    if start + length > len(mapped):
+        raise ValueError("spool record runs past the end of the file")
+    return json.loads(mapped[start:start + length].decode('utf-8')), start + length
+
+def iter_outbox_spool(spool):
+    offset = spool['start']
+    end = len(spool['mapped'])
+    while offset < end:
+        record, offset = read_spool_record(spool['mapped'], offset)
+        yield record['name'], record['email'], record['message']
+
+def check_outbox_spool(spool):
+    # Decodes every record once and returns how many there are; raises if any is cut short or is not an email record.
+    count = 0
+    offset = spool['start']
+    end = len(spool['mapped'])
+    while offset < end:
+        record, offset = read_spool_record(spool['mapped'], offset)
+        if not isinstance(record, dict) or not all(key in record for key in ('name', 'email', 'message')):
+            raise ValueError("spool record is not an email")
+        count += 1
+    return count
+
+def count_outbox_spool(spool):
+    return spool['count']
+
+def close_outbox_spool(spool):
+    spool['mapped'].close()
+
+def emailing_spool(spool, from_address, password, debug=False, verbose=False, workers=1, max_per_second=None, host='smtp.gmail.com', port=587, use_starttls=True, metrics=None, journal=None, delivered=None, relays=None, dry_run=None):
+    total_emails = count_outbox_spool(spool)
+    print()
+    messages = iter_outbox_spool(spool)
+    if delivered:
+        messages = (job for job in messages if job[0] not in delivered)
+        skipped = len(delivered)
+        total_emails -= skipped
+        print(f"Skipping {skipped} participants who were already emailed.")
+    invalid_emails = dispatch_emails(messages, from_address, password, debug, verbose, workers, max_per_second, host, port, use_starttls, metrics, journal, relays=relays, dry_run=dry_run)
+    print()
+    print(f"Emailing complete. {total_emails - invalid_emails} out of {total_emails} emails were sent successfully.")
+    return invalid_emails
+
+
+#RELAYS
+def new_relay(from_address, password, host='smtp.gmail.com', port=587, use_starttls=True, connections=1, max_per_second=None, daily_quota=0, name=None):
+    return {
+        'name': name or f"{from_address}@{host}",
+        'from_address': from_address,
+        'password': password,
+        'host': host,
+        'port': port,
+        'use_starttls': use_starttls,
+        'connections': max(1, int(connections)),
+        'max_per_second': max_per_second,
+        'daily_quota': int(daily_quota or 0),
+        'used': 0,
+        'window_start': time.time(),
+        'assigned': 0,
+        'healthy': True,
+        'connect_failures': 0,
+    }
+
+def new_relay_pool(relays, state_file=None, window_hours=24):
+    return {'relays': relays, 'state_file': state_file, 'window': window_hours * 3600, 'lock': threading.Lock()}
+
+def load_relays(filename):
+    # A relays file is a JSON list of sender accounts, or an object with "relays" and an optional "window_hours".
+    # Quota used so far is kept next to it in <name>.quota.json so it carries over between runs.
+    try:
+        with open(filename, 'r') as file:
+            config = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read the relays file '{filename}': {e}")
+        return None
+    if isinstance(config, list):
+        config = {'relays': config}
+    relays = []
+    for counter, entry in enumerate(config.get('relays', []), start=1):
+        if not entry.get('from_address'):
+            print(f"Relay #{counter} in '{filename}' has no from_address.")
+            return None
+        password = entry.get('password') or os.getenv(entry.get('password_env', "PASSWORD"))
+        relays.append(new_relay(entry['from_address'], password, entry.get('host', 'smtp.gmail.com'), int(entry.get('port', 587)), entry.get('starttls', True), entry.get('connections', 1), entry.get('rate_limit'), entry.get('daily_quota', 0), entry.get('name')))
+    if not relays:
+        print(f"The relays file '{filename}' does not list any relays.")
+        return None
+    pool = new_relay_pool(relays, os.path.splitext(filename)[0] + ".quota.json", float(config.get('window_hours', 24)))
+    load_relay_quota(pool)
+    return pool
+
+def read_relay_quota_file(filename):
+    try:
+        with open(filename, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def load_relay_quota(pool):
+    state = read_relay_quota_file(pool['state_file'])
+    now = time.time()
+    for relay in pool['relays']:
+        saved = state.get(relay['name'])
+        if saved and now - saved['window_start'] < pool['window']:
+            relay['used'] = saved['used']
+            relay['window_start'] = saved['window_start']
+        relay['saved_used'] = relay['used']
+
+def save_relay_quota(pool):
+    # Re-reads the file and adds only this run's usage, so batch groups sharing the relays do not overwrite each other.
+    if not pool['state_file']:
+        return
+    state = read_relay_quota_file(pool['state_file'])
+    for relay in pool['relays']:
+        saved = state.get(relay['name'])
+        used = relay['used']
+        if saved and saved['window_start'] == relay['window_start']:
+            used = saved['used'] + relay['used'] - relay['saved_used']
+        state[relay['name']] = {'window_start': relay['window_start'], 'used': used}
+        relay['saved_used'] = relay['used']
+    temporary = pool['state_file'] + ".tmp"
+    try:
+        with open(temporary, 'w') as file:
+            json.dump(state, file, indent=2)
+        os.replace(temporary, pool['state_file'])
+    except OSError:
+        print(f"Failed to save the relay quota file '{pool['state_file']}'.")
+
+def reserve_relay(pool):
+    # Picks the healthy relay with quota left that has the least work queued for its share of the throughput; None once all are used up or down.
+    with pool['lock']:
+        now = time.time()
+        for relay in pool['relays']:
+            if now - relay['window_start'] >= pool['window']:
+                relay['window_start'] = now
+                relay['used'] = 0
+                relay['saved_used'] = 0
+        candidates = [relay for relay in pool['relays'] if relay['healthy'] and not (relay['daily_quota'] and relay['used'] >= relay['daily_quota'])]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda relay: relay['assigned'] / (relay['max_per_second'] or relay['connections']))
+        best['used'] += 1
+        best['assigned'] += 1
+        return best
+
+def release_relay(pool, relay):
+    with pool['lock']:
+        relay['used'] -= 1
+
+def next_quota_reset(pool):
+    return min(relay['window_start'] for relay in pool['relays'] if relay['daily_quota']) + pool['window']
+
+
+#SEND JOURNAL
+def draw_digest(user_data):
+    digest = hashlib.sha256()
+    for name, data in user_data.items():
+        digest.update(json.dumps([name, data['gifting_to']]).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def open_send_journal(filename):
+    # Append-only JSON lines; every record is flushed and fsync'd before the send is reported, so a crash loses nothing.
+    try:
+        return {'file': open(filename, 'a', encoding='utf-8'), 'filename': filename, 'lock': threading.Lock(), 'digest': None}
+    except OSError:
+        print(f"Failed to open the send journal '{filename}'. Please ensure the file is accessible.")
+        return None
+
+def append_journal_record(journal, record):
+    record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    line = json.dumps(record) + "\n"
+    with journal['lock']:
+        journal['file'].write(line)
+        journal['file'].flush()
+        os.fsync(journal['file'].fileno())
+
+def record_journal_draw(journal, user_data, present_count):
+    journal['digest'] = draw_digest(user_data)
+    append_journal_record(journal, {'type': 'draw', 'digest': journal['digest'], 'present_count': present_count, 'pairs': {name: data['gifting_to'] for name, data in user_data.items()}})
+
+def record_journal_spool(journal, spool_filename, header):
+    journal['digest'] = header['digest']
+    append_journal_record(journal, {'type': 'draw', 'digest': header['digest'], 'present_count': header['present_count'], 'spool': spool_filename})
+
+def record_send_attempt(journal, name, email, status, attempts, error=''):
+    append_journal_record(journal, {'type': 'send', 'digest': journal['digest'], 'name': name, 'email': email, 'status': status, 'attempts': attempts, 'error': error})
+
+def close_send_journal(journal):
+    if journal is not None:
+        journal['file'].close()
+
+def read_send_journal(filename):
+    # Returns the latest draw in the journal and the names already emailed for it.
+    draw = None
+    delivered = set()
+    try:
+        with open(filename, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') == 'draw':
+                    draw = record
+                    delivered = set()
+                elif record.get('type') == 'send' and draw is not None and record.get('digest') == draw['digest']:
+                    if record['status'] in ('sent', 'unchanged'):
+                        delivered.add(record['name'])
+    except OSError:
+        print(f"Failed to read the send journal '{filename}'. Please ensure the file exists and is accessible.")
+    return draw, delivered
+
+def restore_journal_draw(user_data, draw):
+    if not draw.get('pairs'):
+        print("The journal's draw was sent from an outbox spool. Please resume it with --send-spool instead.")
+        return False
+    return apply_saved_pairs(user_data, draw['pairs'], "The journal's draw", draw['present_count'])
+
+
+#PAIR HISTORY
+def open_pair_history(filename):
+    # One row per gift in a past draw, keyed by email so renamed participants are still recognised.
+    import sqlite3
+    try:
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE IF NOT EXISTS pairs (year INTEGER NOT NULL, giver TEXT NOT NULL, receiver TEXT NOT NULL, PRIMARY KEY (year, giver, receiver))")
+        return connection
+    except sqlite3.Error as e:
+        print(f"Failed to open the pair history '{filename}': {e}")
+        return None
+
+def load_pair_history(connection, years, current_year=None):
+    # Returns [(year, {(giver email, receiver email)})] for the last `years` draws before this year's, newest first.
+    if current_year is None:
+        current_year = time.localtime().tm_year
+    history = {}
+    for year, giver, receiver in connection.execute("SELECT year, giver, receiver FROM pairs WHERE year >= ? AND year < ?", (current_year - years, current_year)):
+        history.setdefault(year, set()).add((giver, receiver))
+    return sorted(history.items(), reverse=True)
+
+def history_exclusions(names, emails, history):
+    # Turns each year's email pairs into the (giver, receiver) name pairs the matchers exclude, with one dict lookup per pair.
+    names_by_email = {email.lower(): name for name, email in zip(names, emails)}
+    by_year = []
+    for year, pairs in history:
+        exclusions = set()
+        for giver, receiver in pairs:
+            giver_name = names_by_email.get(giver)
+            receiver_name = names_by_email.get(receiver)
+            if giver_name is not None and receiver_name is not None:
+                exclusions.add((giver_name, receiver_name))
+        by_year.append((year, exclusions))
+    return by_year
+
+def assign_avoiding_history(assign, exclusions, history):
+    # Avoids every remembered pair first, then lets the oldest remembered year's pairs back in until a draw is found.
+    history = list(history)
+    exclusions = set(exclusions or ())
+    while True:
+        combined = exclusions.union(*(pairs for year, pairs in history))
+        if assign(combined):
+            return True
+        if not history:
+            return False
+        year, pairs = history.pop()
+        print(f"Repeating pairs from {year} is allowed again so that a valid draw can be found.")
+
+def record_pair_history(connection, user_data, year=None):
+    # Replaces whatever was remembered for these givers this year, so drawing again in the same year does not pile up rows.
+    import sqlite3
+    if year is None:
+        year = time.localtime().tm_year
+    emails = {name: data['email'].lower() for name, data in user_data.items()}
+    try:
+        with connection:
+            connection.executemany("DELETE FROM pairs WHERE year = ? AND giver = ?", ((year, email) for email in emails.values()))
+            connection.executemany("INSERT OR IGNORE INTO pairs VALUES (?, ?, ?)", ((year, emails[name], emails[receiver]) for name, gifting_to in iter_gifting_pairs(user_data) for receiver in gifting_to))
+    except sqlite3.Error as e:
+        print(f"Failed to record this draw in the pair history: {e}")
+        return False
+    return True
+
+def close_pair_history(connection):
+    if connection is not None:
+        connection.close()
+
+
+#METRICS
+SMTP_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RunMetrics:
+    # Wall-clock time per pipeline stage, latency histograms per SMTP phase and event counters for one run.
+    # Safe to share between email worker threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.phases = {}
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            summary = self.phases.get(phase)
+            if summary is None:
+                summary = self.phases[phase] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(SMTP_LATENCY_BUCKETS)}
+            summary['count'] += 1
+            summary['sum'] += seconds
+            summary['max'] = max(summary['max'], seconds)
+            for i, bound in enumerate(SMTP_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    summary['buckets'][i] += 1
+                    break
+
+    def increment(self, event, amount=1):
+        with self.lock:
+            self.counters[event] += amount
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                'smtp_phases': {phase: {'count': summary['count'], 'sum': round(summary['sum'], 6), 'max': round(summary['max'], 6), 'buckets': list(summary['buckets'])} for phase, summary in self.phases.items()},
+                'counters': dict(self.counters),
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        return metrics_to_prometheus([({}, self.to_dict())])
+
+def metrics_to_prometheus(labelled_metrics):
+    # labelled_metrics is a list of (labels, RunMetrics.to_dict()) pairs, such as one per batch group.
+    def label_text(labels, **extra):
+        merged = dict(labels, **extra)
+        if not merged:
+            return ''
+        return '{' + ','.join(f'{key}="{str(value)}"' for key, value in merged.items()) + '}'
+
+    lines = ["# HELP secret_santa_stage_seconds Wall-clock seconds spent in each pipeline stage.", "# TYPE secret_santa_stage_seconds gauge"]
+    for labels, metrics in labelled_metrics:
+        for name, seconds in metrics['stages'].items():
+            lines.append(f"secret_santa_stage_seconds{label_text(labels, stage=name)} {seconds}")
+
+    lines += ["# HELP secret_santa_smtp_phase_seconds Latency of each SMTP phase.", "# TYPE secret_santa_smtp_phase_seconds histogram"]
+    for labels, metrics in labelled_metrics:
+        for phase, summary in metrics['smtp_phases'].items():
+            cumulative = 0
+            for bound, count in zip(SMTP_LATENCY_BUCKETS, summary['buckets']):
+                cumulative += count
+                lines.append(f"secret_santa_smtp_phase_seconds_bucket{label_text(labels, phase=phase, le=bound)} {cumulative}")
+            lines.append(f"secret_santa_smtp_phase_seconds_bucket{label_text(labels, phase=phase, le='+Inf')} {summary['count']}")
+            lines.append(f"secret_santa_smtp_phase_seconds_sum{label_text(labels, phase=phase)} {summary['sum']}")
+            lines.append(f"secret_santa_smtp_phase_seconds_count{label_text(labels, phase=phase)} {summary['count']}")
+
+    lines += ["# HELP secret_santa_events_total Count of emails, connections, retries and failures.", "# TYPE secret_santa_events_total counter"]
+    for labels, metrics in labelled_metrics:
+        for event, count in metrics['counters'].items():
+            lines.append(f"secret_santa_events_total{label_text(labels, event=event)} {count}")
+    return "\n".join(lines) + "\n"
+
+def write_metrics(labelled_metrics, filename):
+    # Files ending in .prom are written in the Prometheus text format, anything else as JSON.
+    try:
+        with open(filename, 'w') as file:
+            if filename.lower().endswith('.prom'):
+                file.write(metrics_to_prometheus(labelled_metrics))
+            elif len(labelled_metrics) == 1 and not labelled_metrics[0][0]:
+                json.dump(labelled_metrics[0][1], file, indent=2)
+            else:
+                json.dump([dict(labels, metrics=metrics) for labels, metrics in labelled_metrics], file, indent=2)
+        return True
+    except OSError:
+        print(f"Failed to write metrics to the file '{filename}'. Please ensure the file is accessible.")
+        return False
+
+def print_metrics_summary(metrics):
+    summary = metrics.to_dict()
+    print()
+    print("Timing summary:")
+    for name, seconds in summary['stages'].items():
+        print(f"  {name}: {seconds:.3f}s")
+    for phase, latency in summary['smtp_phases'].items():
+        print(f"  SMTP {phase}: {latency['count']} calls, {latency['sum'] / latency['count'] * 1000:.1f}ms average, {latency['max'] * 1000:.1f}ms slowest")
+    for event, count in summary['counters'].items():
+        print(f"  {event.replace('_', ' ')}: {count}")
+
+
+#COMPACT STORAGE
+class ParticipantStore:
+    # Column-oriented participant data for very large draws: participant i is row i of every column,
+    # and the draw is one dense int array of participant_count * present_count recipient ids.
+    __slots__ = ('names', 'emails', 'addresses', 'delivery_instructions', 'households', 'present_count', 'assignment', '_name_index', '_in_degree')
+
+    def __init__(self, present_count):
+        self.names = []
+        self.emails = []
+        self.addresses = []
+        self.delivery_instructions = []
+        self.households = []
+        self.present_count = present_count
+        self.assignment = array('i')
+        self._name_index = None
+        self._in_degree = None
+
+    @classmethod
+    def from_file(cls, filename, present_count, collect_errors=False):
+        store = cls(present_count)
+        report = {}
+        try:
+            for name, email, address, delivery_instructions, household in read_user_rows(filename, collect_errors, report):
+                store.add(name, email, address, delivery_instructions, household)
+        except:
+            print(f"Failed to read the file '{filename}'. Please ensure the file exists and is accessible as a csv.")
+            return store, False
+        return store, report['errors'] == 0
+
+    @classmethod
+    def from_user_data(cls, user_data, present_count):
+        store = cls(present_count)
+        for name, data in user_data.items():
+            store.add(name, data['email'], data['address'], data['delivery_instructions'], data.get('household', 'N/A'))
+        if all(len(data['gifting_to']) == present_count for data in user_data.values()):
+            index = store.name_index()
+            store.assignment = array('i', (index[receiver] for data in user_data.values() for receiver in data['gifting_to']))
+        return store
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, email, address='N/A', delivery_instructions='N/A', household='N/A'):
+        self.names.append(name)
+        self.emails.append(email)
+        self.addresses.append(address)
+        self.delivery_instructions.append(delivery_instructions)
+        self.households.append(household)
+        self._name_index = None
+        self.clear_assignment()
+
+    def name_index(self):
+        if self._name_index is None:
+            self._name_index = {name: i for i, name in enumerate(self.names)}
+        return self._name_index
+
+    def clear_assignment(self):
+        self.assignment = array('i')
+        self._in_degree = None
+
+    def is_assigned(self):
+        return len(self.assignment) == len(self.names) * self.present_count and self.present_count > 0
+
+    def assign(self, exclusions=None, rng=None, processes=None, seed=None):
+        assignment = match_participants(self.names, self.households, self.present_count, exclusions, rng, processes, seed)
+        if assignment is None:
+            return False
+        self.assignment = assignment
+        self._in_degree = None
+        return True
+
+    def set_pairs(self, pairs):
+        # Restores a draw given as {name: [recipient names]}, such as one read back from a send journal, if it is a valid one.
+        index = self.name_index()
+        if len(pairs) != len(self.names) or any(name not in pairs for name in self.names):
+            return False
+        assignment = array('i')
+        for name in self.names:
+            gifting_to = pairs[name]
+            if len(gifting_to) != self.present_count or any(receiver not in index for receiver in gifting_to):
+                return False
+            assignment.extend(index[receiver] for receiver in gifting_to)
+        if not validate_gifting_assignment(assignment, len(self.names), self.present_count)['valid']:
+            return False
+        self.assignment = assignment
+        self._in_degree = None
+        return True
+
+    def gifting_to(self, index):
+        start = index * self.present_count
+        return self.assignment[start:start + self.present_count]
+
+    def in_degree(self):
+        if self._in_degree is None:
+            self._in_degree = array('i', [0]) * len(self.names)
+            for receiver in self.assignment:
+                self._in_degree[receiver] += 1
+        return self._in_degree
+
+    def participant(self, index):
+        if self.is_assigned():
+            gifting_to = [self.names[receiver] for receiver in self.gifting_to(index)]
+            unassigned_gifters = self.present_count - self.in_degree()[index]
+        else:
+            gifting_to = []
+            unassigned_gifters = self.present_count
+        return {'email': self.emails[index], 'address': self.addresses[index], 'delivery_instructions': self.delivery_instructions[index], 'household': self.households[index], 'gifting_to': gifting_to, 'number_of_unassigned_gifters': unassigned_gifters}
+
+    def user_data_view(self):
+        return UserDataView(self)
+
+    def to_user_data(self):
+        return {name: self.participant(index) for index, name in enumerate(self.names)}
+
+
+class UserDataView(collections.abc.Mapping):
+    # Read-only stand-in for the usual user_data dict; each participant's dict is built only when it is looked up,
+    # so emailing_users(), save_pairs_to_file() and evaluate_gifting_pairs() can run straight off a ParticipantStore.
+    __slots__ = ('store',)
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, name):
+        return self.store.participant(self.store.name_index()[name])
+
+    def __iter__(self):
+        return iter(self.store.names)
+
+    def __len__(self):
+        return len(self.store.names)
+
+    def items(self):
+        for index, name in enumerate(self.store.names):
+            yield name, self.store.participant(index)
+
+
 #MAIN FUNCTIONS
 def get_present_count():
     inside_valid = False
@@ -250,7 +2017,7 @@ def message_user_input(present_count, debug=False):
         while not valid:
             valid = True
             print()
-            print("Messages can use [reciever_name], [gifter_name], [delivery_instructions] and [reciver_address] as placeholders in the message as needed.")
+            print("Messages can use [receiver_name], [gifter_name], [delivery_instructions] and [receiver_address] as placeholders in the message as needed.")
             if message_source == 1:
                 input_file = input("Please enter the file name of the text file containing the message that will be used in the email: ")
                 try:
@@ -259,15 +2026,20 @@ def message_user_input(present_count, debug=False):
                 except:
                     print(f"Failed to read the file '{input_file}'. Please ensure the file exists and is accessible.")
                     valid = False
+                    continue
             else:
                 message = input("Please enter the message you want to be used in the email: ")
 
+            template = compile_message_template(message)
             if "[gifter_name]" not in message:
                 print("The message will not send the name of who the user needs to gift their present to. Please include [gifter_name] in the message.")
                 valid = False
+            elif template['misspelled']:
+                for found, suggestion in template['misspelled']:
+                    print(f"The placeholder '[{found}]' is not recognised and would be sent as written. Did you mean '[{suggestion}]'?")
+                valid = False
             else:
-                temp_msg = message
-                temp_msg = temp_msg.replace("[gifter_name]", "GIFTER_NAME").replace("[receiver_name]", "RECEIVER_NAME").replace("[receiver_address]", "RECEIVER_ADDRESS").replace("[delivery_instructions]", "DELIVERY_INSTRUCTIONS")
+                temp_msg = render_message(template, {placeholder: placeholder.upper() for placeholder in MESSAGE_PLACEHOLDERS})
                 print("Please confirm this is your intended message. Note that your parameters to be replaced should be replaced in this message without brackets and in caps:")
                 print()
                 print("\'" + temp_msg + "\'")
@@ -296,100 +2068,117 @@ def message_user_input(present_count, debug=False):
             
             if user_source == 1:          
                 print("Each line should contain two or three elements seperated by commas.")
-                print("the first being the name, second being the email,  third (optionally) containing their address, and fourth (optionally) containing any delivery instructions.")
+                print("the first being the name, second being the email,  third (optionally) containing their address, fourth (optionally) containing any delivery instructions, and fifth (optionally) containing their household.")
                 print("Ensure the csv file does not contain a header row.")
                 print()
                 input_file = input("Please enter the file name of the csv file containing the user data of the participants: ")
-                user_data, valid = import_user_data_from_file(input_file, present_count)
+                user_data, valid = import_user_data_from_file(input_file, present_count, collect_errors=True)
             else:
                 user_data = import_user_data_from_terminal(present_count)
     
     else:
         with open('message.txt', 'r') as file:
             message = file.read()
+        for found, suggestion in compile_message_template(message)['misspelled']:
+            print(f"The placeholder '[{found}]' is not recognised and will be sent as written. Did you mean '[{suggestion}]'?")
         user_data, valid = import_user_data_from_file('list.csv', present_count)
         
     return message, user_data
 
-def determine_gifting_pairs(user_data, present_count):
-    while present_count >= len(list(user_data.keys())):
-        adjustment_choice = -1
-        while adjustment_choice != 1 and adjustment_choice != 2:
-            if (adjustment_choice != -1):
-                print("Invalid input. Please enter only the number 1 or the number 2.")
-            print()
-            print("Not enough participants to assign gifting pairs based on the current gift count per participant. Please adjust the gift count or add more participants.")
-            input_value = input("Enter (1) to adjust gift count or (2) to add more participants: ")
-            
-            try:
-                adjustment_choice = int(input_value)
-            except:
-                adjustment_choice = 100
-
-        if adjustment_choice == 1:
-            present_count = get_present_count()
-            for name in user_data.keys():
-                user_data[name]['gifting_to'] = []
-                user_data[name]['number_of_unassigned_gifters'] = present_count
-        else:
-            user_data = import_user_data_from_terminal(present_count, prior_count=len(user_data)+1, prior_user_data=user_data)
-
-    round = 1
-    while round != present_count + 1:
-        gifting_dict = {}
-        minimum_len = len(list(user_data.keys()))
-        giver = None
-        for name, data in user_data.items():
-            if len(data['gifting_to']) == round - 1:
-                gifting_dict[name] = []
-                for other_name, other_data in user_data.items():
-                    if other_name != name and other_name not in data['gifting_to'] and other_data['number_of_unassigned_gifters'] == present_count - round + 1:
-                        gifting_dict[name].append(other_name)
-                if len(gifting_dict[name]) < minimum_len:
-                    minimum_len = len(gifting_dict[name])
-                    giver = name
-        if len(list(gifting_dict.keys())) == 0:
-            round += 1
-            continue
-        reciever = random.choice(gifting_dict[giver])
-        user_data[giver]['gifting_to'].append(reciever)
-        user_data[reciever]['number_of_unassigned_gifters'] -= 1
+def adjust_participants_or_gift_count(user_data, present_count, reason):
+    adjustment_choice = -1
+    while adjustment_choice != 1 and adjustment_choice != 2:
+        if (adjustment_choice != -1):
+            print("Invalid input. Please enter only the number 1 or the number 2.")
+        print()
+        print(reason)
+        input_value = input("Enter (1) to adjust gift count or (2) to add more participants: ")
         
+        try:
+            adjustment_choice = int(input_value)
+        except:
+            adjustment_choice = 100
+
+    if adjustment_choice == 1:
+        present_count = get_present_count()
+        for name in user_data.keys():
+            user_data[name]['gifting_to'] = []
+            user_data[name]['number_of_unassigned_gifters'] = present_count
+    else:
+        user_data = import_user_data_from_terminal(present_count, prior_count=len(user_data)+1, prior_user_data=user_data)
     return user_data, present_count
 
-def emailing_users(user_data, message, from_address, password, debug=False, verbose=False):
-    invalid_emails = 0
-    total_emails = len(list(user_data.keys()))
-    print()
-    for name, data in user_data.items():
-        names = ""    
-        addresses = ""
-        for gifting_to in data['gifting_to']:
-            names = names + gifting_to + ", "
-            addresses = addresses + user_data[gifting_to]['address'] + ", "
-            delivery_instructions = user_data[gifting_to]['delivery_instructions'] + "; "
-        names = names[:-2]
-        addresses = addresses[:-2]
-        delivery_instructions = delivery_instructions[:-2]
-        
-        personalized_message = message.replace("[gifter_name]", name)
-        personalized_message = personalized_message.replace("[receiver_name]", names)
-        personalized_message = personalized_message.replace("[receiver_address]", addresses)
-        personalized_message = personalized_message.replace("[delivery_instructions]", delivery_instructions)
-        email_success = emailing(from_address, password, data['email'], personalized_message, False, debug, verbose)
-        if email_success:
-            print(f"Email successfully sent to {name} ({data['email']}) for gifting.")
+def exclusion_user_input(user_data, debug=False):
+    if debug:
+        if not os.path.exists('exclusions.csv'):
+            return set()
+        exclusions, valid = import_exclusions_from_file('exclusions.csv', user_data)
+        return exclusions
+
+    valid = False
+    while not valid:
+        print()
+        print("Participants who must not draw each other (such as spouses, or last year's pairs) can be listed in a csv file, with one group of names per line.")
+        input_file = input("Please enter the file name of the csv file containing these groups, or simply press enter to skip: ")
+        if input_file == '':
+            return set()
+        exclusions, valid = import_exclusions_from_file(input_file, user_data)
+    return exclusions
+
+def match_participants(names, households, present_count, exclusions=None, rng=None, processes=None, seed=None):
+    # Picks the matcher for a draw and returns its flat assignment, or None when the rules leave no valid draw.
+    # A seed makes every matcher repeatable, not only the sharded one.
+    if rng is None and seed is not None:
+        rng = random.Random(f"{seed}:draw")
+    has_households = any(household != 'N/A' for household in households)
+    if not exclusions and not has_households and processes:
+        return sharded_gifting_assignment(len(names), present_count, seed, processes)
+    if not exclusions and not has_households:
+        return generate_gifting_assignment(len(names), present_count, rng)
+    excluded = build_exclusion_index(names, exclusions)
+    return constrained_gifting_assignment(len(names), present_count, excluded, households if has_households else None, rng, names)
+
+def assign_gifting_pairs(user_data, present_count, exclusions=None, rng=None, processes=None, seed=None):
+    names = list(user_data.keys())
+    households = [data.get('household', 'N/A') for data in user_data.values()]
+    assignment = match_participants(names, households, present_count, exclusions, rng, processes, seed)
+    if assignment is None:
+        return False
+    apply_gifting_assignment(user_data, names, assignment, present_count)
+    return True
+
+def determine_gifting_pairs(user_data, present_count, exclusions=None, history=None, processes=None, seed=None):
+    while True:
+        while present_count >= len(list(user_data.keys())):
+            user_data, present_count = adjust_participants_or_gift_count(user_data, present_count, "Not enough participants to assign gifting pairs based on the current gift count per participant. Please adjust the gift count or add more participants.")
+
+        if history:
+            past_pairs = history_exclusions(list(user_data), [data['email'] for data in user_data.values()], history)
+            assigned = assign_avoiding_history(lambda combined: assign_gifting_pairs(user_data, present_count, combined, processes=processes, seed=seed), exclusions, past_pairs)
         else:
-            print(f"Failed to send email to {name} ({data['email']}) for gifting.")
-            invalid_emails += 1
+            assigned = assign_gifting_pairs(user_data, present_count, exclusions, processes=processes, seed=seed)
+        if assigned:
+            return user_data, present_count
+        user_data, present_count = adjust_participants_or_gift_count(user_data, present_count, "No gifting pairs can satisfy the exclusion rules with the current gift count per participant. Please adjust the gift count or add more participants.")
+
+def emailing_users(user_data, message, from_address, password, debug=False, verbose=False, workers=1, max_per_second=None, host='smtp.gmail.com', port=587, use_starttls=True, metrics=None, journal=None, delivered=None, relays=None, dry_run=None):
+    total_emails = len(user_data)
+    print()
+    messages = render_user_messages(message, user_data)
+    if delivered:
+        total_emails -= sum(1 for name in user_data if name in delivered)
+        print(f"Skipping {len(user_data) - total_emails} participants who were already emailed.")
+        messages = (job for job in messages if job[0] not in delivered)
+    invalid_emails = dispatch_emails(messages, from_address, password, debug, verbose, workers, max_per_second, host, port, use_starttls, metrics, journal, relays=relays, dry_run=dry_run)
     print()
     print(f"Emailing complete. {total_emails - invalid_emails} out of {total_emails} emails were sent successfully.")
     return invalid_emails
 
-def save_pairs_to_file(user_data, debug=False):
-
-    filename = "gifting_pairs.txt"
-    if not debug:
+def save_pairs_to_file(user_data, debug=False, filename=None):
+    interactive = not debug and filename is None
+    if filename is None:
+        filename = "gifting_pairs.txt"
+    if interactive:
         valid = False
         while not valid:
             valid = True
@@ -399,33 +2188,16 @@ def save_pairs_to_file(user_data, debug=False):
                 filename = "gifting_pairs.txt"
             elif filename.lower() == 'n':
                 return '', True
-            elif filename.lower().endswith('.txt') == False:
-                print("Invalid file name. Please ensure the file name ends with .txt")
+            elif os.path.splitext(filename)[1].lower() not in PAIRS_FORMATS:
+                print(f"Invalid file name. Please ensure the file name ends with {', '.join(PAIRS_FORMATS[:-1])} or {PAIRS_FORMATS[-1]}")
                 valid = False
             else:
                 saving = input(f"Are you sure you want to save the gifting pairs to the file '{filename}'? Type 'y' to confirm or press enter to cancel: ")
                 if saving.lower() != 'y':
                     valid = False
     try:
-        with open(filename, 'w') as file:
-            file.write(f"Gifting Matches:\n")
-            for name, data in user_data.items():
-                list_len = len(data['gifting_to'])
-                counter = 0
-                names = f'Participant: {name}, Gifting To: '
-                for gifting_to in data['gifting_to']:
-                    counter += 1
-                    if counter == list_len and list_len != 1:
-                        names += 'and ' + gifting_to
-                    elif list_len != 2 and list_len != 1:
-                        names += gifting_to + ", "
-                    elif list_len == 1:
-                        names += gifting_to
-                    else:
-                        names += gifting_to + " "
-             
-                file.write(f"{names}\n")
-        if not debug:
+        write_pairs_file(filename, user_data)
+        if interactive:
             print()
             print(f"Gifting pairs successfully saved to '{filename}'.")
             print()
@@ -434,15 +2206,228 @@ def save_pairs_to_file(user_data, debug=False):
             if continue_or_exit.lower() != 'y':
                 return filename, False
         return filename, True
-    except:
+    except Exception as e:
         print(f"Failed to save gifting pairs to the file '{filename}'. Please ensure the file is accessible.")
+        if debug:
+            print(f"Error: {e}")
         return filename, False
     
 
-def main():
+#BATCH MODE
+def load_batch_manifest(filename):
+    # A manifest is a JSON list of groups, or an object with "groups" and shared "defaults".
+    # Relative file names inside it are taken relative to the manifest itself.
+    with open(filename, 'r') as file:
+        manifest = json.load(file)
+    if isinstance(manifest, list):
+        manifest = {'groups': manifest}
+    defaults = manifest.get('defaults', {})
+    base_directory = os.path.dirname(os.path.abspath(filename))
+    groups = []
+    for counter, entry in enumerate(manifest.get('groups', []), start=1):
+        group = {'name': f"group-{counter}", 'present_count': 1, 'send': True}
+        group.update(defaults)
+        group.update(entry)
+        for key in ('roster', 'template', 'output', 'exclusions', 'log', 'spool', 'pairs', 'relays', 'history'):
+            if group.get(key):
+                group[key] = os.path.join(base_directory, group[key])
+        if isinstance(group.get('dry_run'), str):
+            group['dry_run'] = os.path.join(base_directory, group['dry_run'])
+        if not group.get('output'):
+            group['output'] = os.path.join(base_directory, f"{group['name']}_gifting_pairs.txt")
+        if not group.get('log'):
+            group['log'] = os.path.splitext(group['output'])[0] + ".log"
+        if group.get('journal'):
+            group['journal'] = os.path.join(base_directory, group['journal'])
+        else:
+            group['journal'] = os.path.splitext(group['output'])[0] + ".journal.jsonl"
+        groups.append(group)
+    return groups
+
+def run_group(group):
+    result = {'name': group['name'], 'participants': 0, 'present_count': group['present_count'], 'sent': 0, 'failed': 0, 'output': group['output'], 'log': group['log'], 'ok': False, 'error': ''}
+    metrics = RunMetrics()
+    try:
+        with open(group['log'], 'w') as log, contextlib.redirect_stdout(log):
+            try:
+                result['error'] = run_group_pipeline(group, result, metrics)
+            except Exception as e:
+                result['error'] = f"Unexpected error: {e}"
+    except OSError as e:
+        result['error'] = f"Failed to write the log '{group['log']}': {e}"
+    result['ok'] = result['error'] == ''
+    result['metrics'] = metrics.to_dict()
+    return result
+
+def run_group_pipeline(group, result, metrics):
+    present_count = int(group['present_count'])
+    with metrics.stage('import'):
+        store, valid = ParticipantStore.from_file(group['roster'], present_count, collect_errors=True)
+    result['participants'] = len(store)
+    if not valid:
+        return f"Invalid roster '{group['roster']}'."
+
+    try:
+        with open(group['template'], 'r') as file:
+            template = compile_message_template(file.read())
+    except OSError:
+        return f"Failed to read the message template '{group['template']}'."
+    if template['misspelled']:
+        return "Unrecognised placeholders in the message template: " + ", ".join(f"[{found}]" for found, suggestion in template['misspelled']) + "."
+
+    exclusions = set()
+    if group.get('exclusions'):
+        exclusions, valid = import_exclusions_from_file(group['exclusions'], store.user_data_view())
+        if not valid:
+            return f"Invalid exclusion file '{group['exclusions']}'."
+
+    draw = None
+    delivered = None
+    if group.get('resume') and os.path.exists(group['journal']):
+        draw, delivered = read_send_journal(group['journal'])
+    if draw is not None:
+        store.present_count = draw['present_count']
+        if not store.set_pairs(draw['pairs']):
+            return f"The participant list no longer matches the draw recorded in '{group['journal']}', or that draw is not valid."
+        user_data = store.user_data_view()
+        print(f"Resuming the draw recorded in '{group['journal']}': {len(delivered)} out of {len(store)} participants were already emailed.")
+    elif group.get('pairs'):
+        # A saved draw replaces matching and saving entirely.
+        with metrics.stage('load_pairs'):
+            pairs = load_gifting_pairs(group['pairs'])
+        if not pairs:
+            return f"Failed to read gifting pairs from '{group['pairs']}'."
+        store.present_count = len(next(iter(pairs.values())))
+        if not store.set_pairs(pairs):
+            return f"The participant list does not match the gifting pairs saved in '{group['pairs']}', or they are not a valid draw."
+        user_data = store.user_data_view()
+        result['present_count'] = store.present_count
+        result['output'] = group['pairs']
+        print(f"Using the gifting pairs saved in '{group['pairs']}'.")
+    else:
+        if present_count >= len(store):
+            return f"Not enough participants ({len(store)}) for {present_count} gifts per participant."
+        pair_history = None
+        past_pairs = []
+        history_file = group.get('history') or os.getenv("PAIR_HISTORY_DB")
+        if history_file:
+            pair_history = open_pair_history(history_file)
+            if pair_history is None:
+                return f"Failed to open the pair history '{history_file}'."
+            past_pairs = history_exclusions(store.names, store.emails, load_pair_history(pair_history, int(group.get('history_years', os.getenv("PAIR_HISTORY_YEARS", "3")))))
+        with metrics.stage('matching'):
+            match_processes = int(group.get('match_processes', os.getenv("MATCH_PROCESSES", "0"))) or None
+            seed = group.get('seed', os.getenv("MATCH_SEED"))
+            assigned = assign_avoiding_history(lambda combined: store.assign(combined, processes=match_processes, seed=seed), exclusions, past_pairs)
+        if not assigned:
+            close_pair_history(pair_history)
+            return "No gifting pairs can satisfy the exclusion rules."
+
+        user_data = store.user_data_view()
+        with metrics.stage('save'):
+            filename, valid = save_pairs_to_file(user_data, filename=group['output'])
+        if valid and pair_history is not None and not group.get('dry_run'):
+            record_pair_history(pair_history, user_data)
+        close_pair_history(pair_history)
+        if not valid:
+            return f"Failed to save gifting pairs to '{group['output']}'."
+
+    if group.get('spool') and (draw is None or not os.path.exists(group['spool'])):
+        with metrics.stage('render'):
+            count = write_outbox_spool(group['spool'], render_user_messages(template, user_data), draw_digest(user_data), store.present_count)
+        if count < 0:
+            return f"Failed to write the outbox spool '{group['spool']}'."
+
+    if group['send'] and group.get('dry_run'):
+        outbox = open_dry_run_outbox(group['dry_run'] if isinstance(group['dry_run'], str) else None)
+        if outbox is None:
+            return f"Failed to open the dry run file '{group['dry_run']}'."
+        with metrics.stage('email'):
+            if group.get('spool'):
+                spool = open_outbox_spool(group['spool'])
+                if spool is None:
+                    outbox.close()
+                    return f"Failed to read the outbox spool '{group['spool']}'."
+                invalid_emails = emailing_spool(spool, None, None, metrics=metrics, delivered=delivered, dry_run=outbox)
+                close_outbox_spool(spool)
+            else:
+                invalid_emails = emailing_users(user_data, template, None, None, metrics=metrics, delivered=delivered, dry_run=outbox)
+        print(outbox.describe())
+        outbox.close()
+        result['sent'] = len(store) - len(delivered or ()) - invalid_emails
+        result['failed'] = invalid_emails
+    elif group['send']:
+        load_dotenv()
+        from_address = group.get('email_address') or os.getenv("EMAIL_ADDRESS")
+        password = os.getenv(group.get('password_env', "PASSWORD"))
+        workers = int(group.get('send_workers', os.getenv("SEND_WORKERS", "1")))
+        rate_limit = float(group.get('send_rate_limit', os.getenv("SEND_RATE_LIMIT", "0")))
+        host = group.get('smtp_host', 'smtp.gmail.com')
+        port = int(group.get('smtp_port', 587))
+        use_starttls = group.get('smtp_starttls', True)
+        relays = None
+        relays_file = group.get('relays') or os.getenv("RELAYS_FILE")
+        if relays_file:
+            relays = load_relays(relays_file)
+            if relays is None:
+                return f"Invalid relays file '{relays_file}'."
+        journal = open_send_journal(group['journal'])
+        if journal is None:
+            return f"Failed to open the send journal '{group['journal']}'."
+        if draw is not None:
+            journal['digest'] = draw['digest']
+        else:
+            record_journal_draw(journal, user_data, store.present_count)
+        with metrics.stage('email'):
+            if group.get('spool'):
+                spool = open_outbox_spool(group['spool'])
+                if spool is None:
+                    close_send_journal(journal)
+                    return f"Failed to read the outbox spool '{group['spool']}'."
+                invalid_emails = emailing_spool(spool, from_address, password, workers=workers, max_per_second=rate_limit, host=host, port=port, use_starttls=use_starttls, metrics=metrics, journal=journal, delivered=delivered, relays=relays)
+                close_outbox_spool(spool)
+            else:
+                invalid_emails = emailing_users(user_data, template, from_address, password, workers=workers, max_per_second=rate_limit, host=host, port=port, use_starttls=use_starttls, metrics=metrics, journal=journal, delivered=delivered, relays=relays)
+        close_send_journal(journal)
+        result['sent'] = len(store) - len(delivered or ()) - invalid_emails
+        result['failed'] = invalid_emails
+        if invalid_emails:
+            return f"{invalid_emails} emails could not be sent."
+    return ''
+
+def run_batch(groups, processes=None):
+    if processes == 1 or len(groups) <= 1:
+        return [run_group(group) for group in groups]
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(run_group, groups))
+
+def print_batch_summary(results):
+    print()
+    print("Batch summary:")
+    for result in results:
+        status = "OK" if result['ok'] else "FAILED"
+        print(f"{status} {result['name']}: {result['participants']} participants, {result['present_count']} gifts each, {result['sent']} emails sent, {result['failed']} failed. Pairs: '{result['output']}'. Log: '{result['log']}'.")
+        if result['error']:
+            print(f"    {result['error']}")
+    failed_groups = sum(1 for result in results if not result['ok'])
+    print(f"{len(results) - failed_groups} out of {len(results)} groups completed successfully.")
+
+
+def main(resume_journal=None, render_spool=None, pairs_file=None, amend_file=None, relays_file=None, history_file=None, history_years=None, match_processes=None, seed=None, dry_run=None, metrics_file=None):
+    metrics = RunMetrics()
     load_dotenv()
     from_address = os.getenv("EMAIL_ADDRESS")
     password = os.getenv("PASSWORD")
+    send_workers = int(os.getenv("SEND_WORKERS", "1"))
+    send_rate_limit = float(os.getenv("SEND_RATE_LIMIT", "0"))
+    metrics_file = metrics_file or os.getenv("METRICS_FILE")
+    journal_file = resume_journal or os.getenv("SEND_JOURNAL", "send_journal.jsonl")
+    relays_file = relays_file or os.getenv("RELAYS_FILE")
+    history_file = history_file or os.getenv("PAIR_HISTORY_DB")
+    history_years = history_years or int(os.getenv("PAIR_HISTORY_YEARS", "3"))
+    match_processes = match_processes or int(os.getenv("MATCH_PROCESSES", "0")) or None
+    seed = seed if seed is not None else os.getenv("MATCH_SEED")
 
     debug = False
     verbose = False
@@ -453,28 +2438,264 @@ def main():
     if len(input_val) > 0 and input_val.lower()[0] == 'v' or (len(input_val) > 1 and input_val.lower()[1] == 'v'):
         verbose = True
         debug = True
+    outbox, valid = dry_run_outbox(dry_run, debug)
+    if not valid:
+        print("No emails were sent.")
+        return
     if debug:
         print("Debug mode activated.")
         present_count = 1
+    elif resume_journal or pairs_file or amend_file:
+        present_count = 1
     else:
         present_count = get_present_count()
         
-    message, user_data = message_user_input(present_count, debug)
-    print("User data prior to matching shown below:")
-    display_user_data(user_data, present_count)
-    user_data, present_count = determine_gifting_pairs(user_data, present_count)
-    
-    filename, valid = save_pairs_to_file(user_data, debug)
+    with metrics.stage('import'):
+        message, user_data = message_user_input(present_count, debug)
 
-    if valid:
-        emailing_users(user_data, message, from_address, password, debug, verbose)
+    draw = None
+    delivered = None
+    pair_history = None
+    history = []
+    if history_file and not (resume_journal or pairs_file):
+        pair_history = open_pair_history(history_file)
+        if pair_history is not None:
+            history = load_pair_history(pair_history, history_years)
+            print(f"Avoiding {sum(len(remembered) for year, remembered in history)} pairs from the last {history_years} years' draws recorded in '{history_file}'.")
+    if resume_journal:
+        draw, delivered = read_send_journal(resume_journal)
+        valid = draw is not None and restore_journal_draw(user_data, draw)
+        if valid:
+            present_count = draw['present_count']
+            print()
+            print(f"Resuming the draw recorded in '{resume_journal}': {len(delivered)} out of {len(user_data)} participants were already emailed.")
+        else:
+            print(f"Could not resume from '{resume_journal}'. Please use the same participant list as the original run.")
+    elif pairs_file:
+        with metrics.stage('load_pairs'):
+            pairs = load_gifting_pairs(pairs_file)
+        valid = bool(pairs) and apply_saved_pairs(user_data, pairs, f"The gifting pairs file '{pairs_file}'")
+        if valid:
+            present_count = len(next(iter(pairs.values())))
+            print()
+            print(f"Using the {len(pairs)} gifting pairs saved in '{pairs_file}' instead of drawing new ones.")
+        else:
+            print(f"Could not use the gifting pairs saved in '{pairs_file}'. Please use the same participant list as the saved draw.")
+    elif amend_file:
+        with metrics.stage('exclusions'):
+            exclusions = exclusion_user_input(user_data, debug)
+        pairs = load_gifting_pairs(amend_file)
+        changed = None
+        if pairs:
+            present_count = len(next(iter(pairs.values()), [])) or present_count
+            past_pairs = history_exclusions(list(user_data), [data['email'] for data in user_data.values()], history)
+            with metrics.stage('matching'):
+                rng = random.Random(f"{seed}:amend") if seed is not None else None
+                changed = amend_gifting_pairs(user_data, pairs, set(exclusions).union(*(remembered for year, remembered in past_pairs)), rng)
+        if changed is None:
+            print(f"The gifting pairs saved in '{amend_file}' could not be carried over to the new participant list, so everyone will be matched again.")
+            with metrics.stage('matching'):
+                user_data, present_count = determine_gifting_pairs(user_data, present_count, exclusions, history, match_processes, seed)
+        else:
+            delivered = {name for name in user_data if name not in changed}
+            joined = sum(1 for name in user_data if name not in pairs)
+            left = sum(1 for name in pairs if name not in user_data)
+            print()
+            print(f"{joined} participants joined and {left} left. Only these {len(changed)} participants have new gifting pairs and will be emailed: {', '.join(sorted(changed))}.")
+        with metrics.stage('save'):
+            filename, valid = save_pairs_to_file(user_data, debug)
+    else:
+        with metrics.stage('exclusions'):
+            exclusions = exclusion_user_input(user_data, debug)
+        print("User data prior to matching shown below:")
+        display_user_data(user_data, present_count)
+        with metrics.stage('matching'):
+            user_data, present_count = determine_gifting_pairs(user_data, present_count, exclusions, history, match_processes, seed)
+        
+        with metrics.stage('save'):
+            filename, valid = save_pairs_to_file(user_data, debug)
+
+    if valid and pair_history is not None and outbox is None:
+        record_pair_history(pair_history, user_data)
+    close_pair_history(pair_history)
+
+    relays = None
+    if valid and relays_file and not render_spool and outbox is None:
+        relays = load_relays(relays_file)
+        valid = relays is not None
+
+    if valid and render_spool:
+        with metrics.stage('render'):
+            messages = render_user_messages(message, user_data)
+            if delivered:
+                messages = (job for job in messages if job[0] not in delivered)
+            count = write_outbox_spool(render_spool, messages, draw_digest(user_data), present_count)
+        if count >= 0:
+            print()
+            print(f"{count} emails were rendered to the outbox spool '{render_spool}'. Check it, then send them with: python main.py --send-spool {render_spool}")
+    elif valid:
+        journal = open_send_journal(journal_file) if outbox is None else None
+        if journal is not None:
+            if draw is not None:
+                journal['digest'] = draw['digest']
+            else:
+                record_journal_draw(journal, user_data, present_count)
+                for name in delivered or ():
+                    record_send_attempt(journal, name, user_data[name]['email'], 'unchanged', 0)
+        with metrics.stage('email'):
+            host, port, use_starttls = smtp_settings_from_env()
+            emailing_users(user_data, message, from_address, password, debug, verbose, send_workers, send_rate_limit, host, port, use_starttls, metrics=metrics, journal=journal, delivered=delivered, relays=relays, dry_run=outbox)
+        close_send_journal(journal)
+        if outbox is not None:
+            print(outbox.describe())
+            outbox.close()
 
         if debug:
             display_user_data(user_data, present_count)
-            evaluate_gifting_pairs(user_data, present_count)
+            with metrics.stage('validation'):
+                evaluate_gifting_pairs(user_data, present_count)
+
+    if debug:
+        print_metrics_summary(metrics)
+    if metrics_file:
+        write_metrics([({}, metrics.to_dict())], metrics_file)
     
     print()
     print("Thank you for using the Secret Santa Emailer! Goodbye.")
 
+def dry_run_outbox(dry_run=None, debug=False):
+    # --dry-run wins; otherwise DRY_RUN in the .env file can be true, false or a file name, and debug mode dry-runs by default.
+    if dry_run is None:
+        value = os.getenv("DRY_RUN", "")
+        if value.lower() in ('0', 'false', 'no'):
+            return None, True
+        if value.lower() in ('1', 'true', 'yes'):
+            dry_run = True
+        else:
+            dry_run = value or debug
+    if not dry_run:
+        return None, True
+    outbox = open_dry_run_outbox(dry_run if isinstance(dry_run, str) else None)
+    return outbox, outbox is not None
+
+def smtp_settings_from_env():
+    host = os.getenv("SMTP_HOST", "smtp.gmail.com")
+    port = int(os.getenv("SMTP_PORT", "587"))
+    use_starttls = os.getenv("SMTP_STARTTLS", "true").lower() not in ('0', 'false', 'no')
+    return host, port, use_starttls
+
+def send_outbox_spool(filename, journal_file=None, relays_file=None, dry_run=None, metrics_file=None):
+    metrics = RunMetrics()
+    load_dotenv()
+    from_address = os.getenv("EMAIL_ADDRESS")
+    password = os.getenv("PASSWORD")
+    send_workers = int(os.getenv("SEND_WORKERS", "1"))
+    send_rate_limit = float(os.getenv("SEND_RATE_LIMIT", "0"))
+    metrics_file = metrics_file or os.getenv("METRICS_FILE")
+    relays_file = relays_file or os.getenv("RELAYS_FILE")
+    if journal_file is None:
+        journal_file = os.path.splitext(filename)[0] + ".journal.jsonl"
+
+    outbox, valid = dry_run_outbox(dry_run)
+    if not valid:
+        return 2
+    relays = None
+    if relays_file and outbox is None:
+        relays = load_relays(relays_file)
+        if relays is None:
+            return 2
+    spool = open_outbox_spool(filename)
+    if spool is None:
+        return 2
+    draw, delivered = read_send_journal(journal_file) if os.path.exists(journal_file) else (None, set())
+    journal = open_send_journal(journal_file) if outbox is None else None
+    if draw is None or draw['digest'] != spool['header']['digest']:
+        delivered = set()
+    if journal is not None:
+        if draw is not None and draw['digest'] == spool['header']['digest']:
+            journal['digest'] = draw['digest']
+        else:
+            record_journal_spool(journal, filename, spool['header'])
+    with metrics.stage('email'):
+        host, port, use_starttls = smtp_settings_from_env()
+        invalid_emails = emailing_spool(spool, from_address, password, workers=send_workers, max_per_second=send_rate_limit, host=host, port=port, use_starttls=use_starttls, metrics=metrics, journal=journal, delivered=delivered, relays=relays, dry_run=outbox)
+    close_send_journal(journal)
+    close_outbox_spool(spool)
+    if outbox is not None:
+        print(outbox.describe())
+        outbox.close()
+    if metrics_file:
+        write_metrics([({}, metrics.to_dict())], metrics_file)
+    return 0 if invalid_emails == 0 else 1
+
+def run_command_line(argv=None):
+    parser = argparse.ArgumentParser(description="Secret Santa Emailer. Runs interactively unless a batch manifest is given.")
+    parser.add_argument('--batch', metavar='MANIFEST', help="run every group in a JSON manifest without prompting")
+    parser.add_argument('--processes', type=int, default=None, help="number of groups to run at the same time in batch mode")
+    parser.add_argument('--metrics', metavar='FILE', help="write timings and SMTP latencies (per group in batch mode) as JSON, or as Prometheus text if FILE ends in .prom; overrides METRICS_FILE")
+    parser.add_argument('--resume', nargs='?', const=True, metavar='JOURNAL', help="finish an interrupted run from its send journal, emailing only participants who have not been emailed yet")
+    parser.add_argument('--render-only', metavar='SPOOL', help="render every email into an outbox spool file instead of sending")
+    parser.add_argument('--send-spool', metavar='SPOOL', help="send the emails in an outbox spool file, skipping any already sent from it")
+    parser.add_argument('--relays', metavar='FILE', help="spread emails across the sender accounts in a JSON relays file, keeping within each one's daily quota")
+    parser.add_argument('--history', metavar='DB', help="remember every draw in a SQLite file and avoid repeating pairs from recent years")
+    parser.add_argument('--history-years', type=int, default=None, help="number of past years whose pairs --history avoids (3 by default)")
+    parser.add_argument('--match-processes', type=int, default=None, help="match very large groups in blocks spread over this many processes")
+    parser.add_argument('--seed', default=None, help="seed for the draw, so the same seed and participant list always give the same pairs")
+    parser.add_argument('--dry-run', nargs='?', const=True, metavar='FILE', help="render and \"send\" every email into memory, or into FILE, without connecting to any email server")
+    parser.add_argument('--pairs', metavar='PAIRS', help="email the gifting pairs saved in a .txt, .csv, .jsonl, .bin or .npz file instead of drawing new ones")
+    parser.add_argument('--amend', metavar='PAIRS', help="carry a saved draw over to an updated participant list, emailing only participants whose gifting pairs changed")
+    parser.add_argument('--validate', metavar='PAIRS', help="check a saved gifting pairs file and report every problem found")
+    parser.add_argument('--gifts', type=int, default=None, help="number of gifts per participant expected by --validate (by default the most common count in the file)")
+    parser.add_argument('--json', action='store_true', help="print the --validate report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.validate:
+        report, names = validate_pairs_file(args.validate, args.gifts)
+        if report is None:
+            return 2
+        if args.json:
+            print(json.dumps(dict(report, names=names), indent=2))
+        else:
+            print_validation_report(report, names)
+        return 0 if report['valid'] else 1
+
+    if args.send_spool:
+        return send_outbox_spool(args.send_spool, relays_file=args.relays, dry_run=args.dry_run, metrics_file=args.metrics)
+
+    if args.batch is None:
+        if args.resume is True:
+            args.resume = os.getenv("SEND_JOURNAL", "send_journal.jsonl")
+        main(args.resume, args.render_only, args.pairs, args.amend, args.relays, args.history, args.history_years, args.match_processes, args.seed, args.dry_run, args.metrics)
+        return 0
+
+    try:
+        groups = load_batch_manifest(args.batch)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read the batch manifest '{args.batch}': {e}")
+        return 2
+    for group in groups:
+        group['resume'] = bool(args.resume)
+        if args.relays and not group.get('relays'):
+            group['relays'] = os.path.abspath(args.relays)
+        if args.history and not group.get('history'):
+            group['history'] = os.path.abspath(args.history)
+        if args.history_years and not group.get('history_years'):
+            group['history_years'] = args.history_years
+        if args.match_processes and not group.get('match_processes'):
+            group['match_processes'] = args.match_processes
+        if args.seed is not None and group.get('seed') is None:
+            group['seed'] = args.seed
+        if isinstance(args.dry_run, str) and not group.get('dry_run'):
+            # Each group gets its own file so groups running at the same time never write to the same one.
+            base, extension = os.path.splitext(os.path.abspath(args.dry_run))
+            group['dry_run'] = f"{base}.{group['name']}{extension}" if len(groups) > 1 else base + extension
+        elif args.dry_run and not group.get('dry_run'):
+            group['dry_run'] = True
+    results = run_batch(groups, args.processes)
+    print_batch_summary(results)
+    if args.metrics:
+        write_metrics([({'group': result['name']}, result['metrics']) for result in results], args.metrics)
+    return 0 if all(result['ok'] for result in results) else 1
+
 if __name__ == "__main__":
-    main()
+    sys.exit(run_command_line())